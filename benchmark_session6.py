@@ -0,0 +1,273 @@
+"""
+Benchmarks for the decorators and closures of `session6`.
+
+Run `python benchmark_session6.py` to measure every benchmark and compare it with the saved baseline in
+`benchmark_baseline.json`. The run fails if any benchmark is worse than its baseline by more than the
+threshold, 25% by default. Run `python benchmark_session6.py --save` to record a new baseline.
+
+`python benchmark_session6.py --scaling` instead reports the speedup of `fibonacci_range` with 1 to
+`os.cpu_count()` processes. It depends on the number of cores, so it is not compared with the baseline.
+On a machine with at least 2 CPUs the run fails if 2 processes are not `--min-speedup` times faster
+than 1, by default 1.0.
+
+Per-call overheads are measured as the ratio of the time of a decorated call to the time of the same
+undecorated call, and the Fibonacci generators as the ratio of their time to that of a plain loop computing
+the same terms, so they are comparable between machines. Memory is measured in bytes per decorated function.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import threading
+import timeit
+import tracemalloc
+
+from session6 import (
+    checker, fibonacci_closure, fibonacci_range, FibonacciStream, function_counter_with_one_dict,
+    function_counter_multi_dict, instrument, ShardedCounter, silent_sink,
+)
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_THRESHOLD = 0.25
+DEFAULT_MIN_SPEEDUP = 1.0
+
+def add(a, b):
+    """
+    Adds two numbers. This is the function every decorator is benchmarked on.
+    """
+    return a + b
+
+def per_call_seconds(fn, calls=100000, repeat=7):
+    """
+    Returns the best-of-`repeat` time in seconds of a single call to `fn`.
+    """
+    return min(timeit.repeat(fn, number=calls, repeat=repeat)) / calls
+
+def overhead_ratio(decorated, rounds=9):
+    """
+    Returns the time of a call to `decorated(1, 2)` relative to a call to the undecorated `add(1, 2)`.
+
+    Both are timed back to back in each of `rounds` rounds, and the median ratio is returned, so that
+    the load of the machine changing during the run affects both sides alike.
+    """
+    ratios = sorted(per_call_seconds(lambda: decorated(1, 2), repeat=3)
+                    / per_call_seconds(lambda: add(1, 2), repeat=3) for _ in range(rounds))
+    return ratios[rounds // 2]
+
+def threaded_seconds(fn, threads, calls):
+    """
+    Returns the time in seconds for `threads` threads to call `fn(1, 2)` `calls` times each.
+    """
+    barrier = threading.Barrier(threads + 1)
+
+    def work():
+        barrier.wait()
+        for _ in range(calls):
+            fn(1, 2)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start = timeit.default_timer()
+    barrier.wait()
+    for worker in workers:
+        worker.join()
+    return timeit.default_timer() - start
+
+def threaded_overhead_ratio(decorated, threads=8, calls=20000, repeat=5):
+    """
+    Returns the median time of `threads` threads calling `decorated` relative to the same threads calling `add`.
+    """
+    ratios = sorted(threaded_seconds(decorated, threads, calls) / threaded_seconds(add, threads, calls)
+                    for _ in range(repeat))
+    return ratios[repeat // 2]
+
+def _make_functions(count):
+    functions = []
+    for i in range(count):
+        def generated(a, b):
+            """
+            A generated function, standing in for one of many decorated handlers.
+            """
+            return a + b
+        generated.__name__ = generated.__qualname__ = f"generated_{i}"
+        functions.append(generated)
+    return functions
+
+def memory_used(build):
+    """
+    Returns the number of bytes allocated by `build()` and kept alive by its result.
+
+    The Python allocations are traced with `tracemalloc`, so that the result is comparable with the
+    baseline. The resident set size would include allocator and page granularity and differ from one
+    machine to another.
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = build()
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    del result
+    return used
+
+def bytes_per_decorated_function(count=20000, compact=False):
+    """
+    Returns the memory in bytes that `function_counter_multi_dict` adds to each decorated function.
+    """
+    functions = _make_functions(count)
+    counts = {}
+    decorator = function_counter_multi_dict(counts, sink=silent_sink, compact=compact)
+    return memory_used(lambda: [decorator(fn) for fn in functions]) / count
+
+def reference_terms(terms, modulus=None):
+    """
+    Computes the first `terms` Fibonacci numbers in a plain loop, the reference for the Fibonacci benchmarks.
+    """
+    a, b = 0, 1
+    if modulus is None:
+        for _ in range(terms):
+            a, b = b, a + b
+    else:
+        for _ in range(terms):
+            a, b = b, (a + b) % modulus
+
+def fibonacci_time_ratio(make_next_term, terms, modulus=None, rounds=9):
+    """
+    Returns the time of the first `terms` calls to a new `make_next_term()` relative to `reference_terms`.
+
+    Both are timed back to back in each of `rounds` rounds, and the median ratio is returned, as for
+    `overhead_ratio`. Every timing starts from a new generator, so the terms do not grow from one to the next.
+    """
+    def produce():
+        next_term = make_next_term()
+        for _ in range(terms):
+            next_term()
+
+    ratios = sorted(min(timeit.repeat(produce, number=1, repeat=5))
+                    / min(timeit.repeat(lambda: reference_terms(terms, modulus), number=1, repeat=5))
+                    for _ in range(rounds))
+    return ratios[rounds // 2]
+
+def fibonacci_range_scaling(stop=4 * 10 ** 6, modulus=10 ** 9 + 7):
+    """
+    Returns the terms per second of `fibonacci_range(0, stop, modulus=modulus)` by number of processes, from
+    1 to the number of CPUs.
+    """
+    results = {}
+    for processes in range(1, (os.cpu_count() or 1) + 1):
+        start = timeit.default_timer()
+        for _ in fibonacci_range(0, stop, modulus=modulus, processes=processes):
+            pass
+        results[processes] = stop / (timeit.default_timer() - start)
+    return results
+
+def run_benchmarks():
+    """
+    Runs every benchmark.
+
+    Returns:
+        dict: The result of every benchmark by name, each with its `value` and whether `lower` is better.
+    """
+    counts = {}
+    sharded = ShardedCounter()
+    results = {
+        "checker_overhead": (overhead_ratio(checker(add, sink=silent_sink)), True),
+        "checker_eager_overhead": (overhead_ratio(checker(add, eager=True, sink=silent_sink)), True),
+        "counter_with_one_dict_overhead": (overhead_ratio(function_counter_with_one_dict(add, sink=silent_sink)), True),
+        "counter_multi_dict_overhead": (overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink)(add)), True),
+        "counter_compact_overhead": (
+            overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink, compact=True)(add)), True),
+        "counter_sharded_overhead": (
+            overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink, backend=sharded)(add)), True),
+        "counter_shapes_overhead": (
+            overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink, shape_dict={})(add)), True),
+        "checker_on_timed_counter_overhead": (overhead_ratio(
+            checker(function_counter_multi_dict(counts, sink=silent_sink, latency_dict={})(add), sink=silent_sink)), True),
+        "instrument_overhead": (
+            overhead_ratio(instrument(counter_dict=counts, latency_dict={}, sink=silent_sink)(add)), True),
+        "counter_multi_dict_8_threads_overhead": (
+            threaded_overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink)(add)), True),
+        "counter_sharded_8_threads_overhead": (
+            threaded_overhead_ratio(function_counter_multi_dict(counts, sink=silent_sink, backend=sharded)(add)), True),
+        "counter_multi_dict_bytes_per_function": (bytes_per_decorated_function(), True),
+        "counter_compact_bytes_per_function": (bytes_per_decorated_function(compact=True), True),
+        "fibonacci_closure_time_ratio": (fibonacci_time_ratio(fibonacci_closure, 5000), True),
+        "fibonacci_closure_mod_time_ratio": (
+            fibonacci_time_ratio(lambda: fibonacci_closure(10 ** 9 + 7), 10 ** 5, modulus=10 ** 9 + 7), True),
+        "fibonacci_stream_time_ratio": (fibonacci_time_ratio(lambda: FibonacciStream().__next__, 5000), True),
+    }
+    return {name: {"value": value, "lower": lower} for name, (value, lower) in results.items()}
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """
+    Compares benchmark results with a baseline.
+
+    Args:
+        results (dict): The results of `run_benchmarks`.
+        baseline (dict): Saved results of `run_benchmarks`. Benchmarks missing from it are not compared.
+        threshold (float): The fraction by which a result may be worse than its baseline.
+
+    Returns:
+        list: A message for every benchmark that regressed by more than `threshold`.
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        value, expected = result["value"], baseline[name]["value"]
+        if result["lower"]:
+            regressed = value > expected * (1 + threshold)
+        else:
+            regressed = value < expected / (1 + threshold)
+        if regressed:
+            regressions.append(f"{name}: {value:.4g} against a baseline of {expected:.4g}")
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the decorators and closures of session6.")
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="the baseline file")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="the fraction by which a benchmark may regress (default: %(default)s)")
+    parser.add_argument("--scaling", action="store_true", help="report the speedup of fibonacci_range by process count")
+    parser.add_argument("--min-speedup", type=float, default=DEFAULT_MIN_SPEEDUP,
+                        help="with --scaling, the speedup 2 processes must reach (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    if args.scaling:
+        scaling = fibonacci_range_scaling()
+        for processes, terms in scaling.items():
+            print(f"{processes:3} processes {terms:12.4g} terms/s {terms / scaling[1]:6.2f}x")
+        if 2 in scaling and scaling[2] / scaling[1] < args.min_speedup:
+            print(f"REGRESSION speedup with 2 processes: {scaling[2] / scaling[1]:.2f}x, "
+                  f"below the minimum of {args.min_speedup:.2f}x")
+            return 1
+        return 0
+
+    results = run_benchmarks()
+    for name, result in results.items():
+        print(f"{name:45} {result['value']:12.4g}")
+
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved the baseline to {args.baseline}")
+        return 0
+    try:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    except FileNotFoundError:
+        print(f"No baseline in {args.baseline}, run with --save to record one")
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,352 @@
+import atexit
+import importlib
+import inspect
+import logging
+import math
+import os
+import random
+import sys
+import threading
 import time
+import weakref
+from array import array
+from collections import OrderedDict, deque
+from fnmatch import fnmatchcase
+from functools import wraps
+from itertools import chain, islice
+from types import MethodType
 
-def checker(fn):
+# multiprocessing, concurrent.futures, pkgutil, mmap, fcntl and json are imported by the functions that use
+# them, so that importing session6 only to decorate functions stays cheap.
+
+DOCSTRING_MIN_CHARS = 50
+
+def print_sink(message):
+    """
+    Writes a report message to stdout with `print`. This is the default sink of every decorator.
+    """
+    print(message)
+
+def silent_sink(message):
+    """
+    Discards report messages. Decorators recognise this sink and skip formatting the message entirely.
+    """
+
+class LoggingSink:
+    """
+    A sink that forwards report messages to a `logging.Logger`.
+
+    Args:
+        logger (logging.Logger): The logger to write to. Defaults to the `session6` logger.
+        level (int): The level the messages are logged at. Defaults to `logging.INFO`.
+
+    Example:
+        @function_counter_multi_dict(counts, sink=LoggingSink(level=logging.DEBUG))
+        def add(a, b):
+            return a + b
+    """
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger("session6")
+        self.level = level
+
+    def __call__(self, message):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, message)
+
+class QueueSink:
+    """
+    A non-blocking sink that buffers report messages and writes them from a background thread in batches.
+
+    Calling the sink only appends the message to a `collections.deque`, which is thread-safe and never blocks,
+    so worker threads no longer serialise on the stdout lock. A daemon thread wakes up every `interval`
+    seconds and writes the buffered messages to `stream` with one `write` per batch of `batch_size` messages.
+    Pending messages are written on `flush()`, on `close()` and at interpreter exit.
+
+    Args:
+        stream (file): The stream to write to. Defaults to `sys.stdout`, looked up at write time.
+        batch_size (int): The maximum number of messages written per `write` call.
+        interval (float): The number of seconds between two drains of the buffer.
+        target (callable): If given, the background thread passes each message to this sink, for instance
+            a `LoggingSink`, instead of writing to `stream`.
+
+    Example:
+        sink = QueueSink()
+        set_default_sink(sink)
+    """
+
+    def __init__(self, stream=None, batch_size=1024, interval=0.05, target=None):
+        if batch_size < 1:
+            raise ValueError("The batch_size argument must be at least 1")
+        self.stream = stream
+        self.target = target
+        self.batch_size = batch_size
+        self.interval = interval
+        self._queue = deque()
+        self._drain_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="session6-queue-sink", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __call__(self, message):
+        self._queue.append(message)
+
+    def _run(self):
+        while not self._closed:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        """
+        Writes every buffered message to the stream, or passes it to the target, in the order the messages were reported.
+        """
+        queue = self._queue
+        batch_size = self.batch_size
+        with self._drain_lock:
+            if self.target is not None:
+                while queue:
+                    self.target(queue.popleft())
+                return
+            stream = self.stream if self.stream is not None else sys.stdout
+            while queue:
+                batch = []
+                try:
+                    while len(batch) < batch_size:
+                        batch.append(queue.popleft())
+                except IndexError:
+                    pass
+                stream.write("\n".join(batch) + "\n")
+            stream.flush()
+
+    def close(self):
+        """
+        Stops the background thread after writing every buffered message. Closing twice is a no-op.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._wakeup.set()
+        self._thread.join()
+        self.flush()
+        atexit.unregister(self.close)
+
+_default_sink = print_sink
+
+def set_default_sink(sink):
+    """
+    Sets the sink used by every decorator that was not given an explicit `sink` argument.
+
+    The default is looked up on each report, so this also applies to functions that are already decorated.
+
+    Args:
+        sink (callable): A callable taking one message string, e.g. `print_sink`, `silent_sink`,
+            a `LoggingSink` or a `QueueSink`.
+
+    Raises:
+        TypeError: If the sink is not callable.
+
+    Returns:
+        callable: The previous default sink.
+    """
+    global _default_sink
+    if not callable(sink):
+        raise TypeError("The sink argument must be callable")
+    previous = _default_sink
+    _default_sink = sink
+    return previous
+
+def get_default_sink():
+    """
+    Returns the sink used by decorators that were not given an explicit `sink` argument.
+    """
+    return _default_sink
+
+def _check_sink(sink):
+    """
+    Raises a TypeError if an explicit `sink` argument passed to a decorator is not callable.
+    """
+    if sink is not None and not callable(sink):
+        raise TypeError("The sink argument must be callable")
+
+_background_queues = {}
+_background_queues_lock = threading.Lock()
+
+def _deliver(item):
+    """
+    Passes a message queued by `_nonblocking_report` to its sink, from the background thread.
+    """
+    sink, message = item
+    try:
+        sink(message)
+    except Exception:
+        # One failing sink must not stop the thread delivering the reports of every other sink.
+        logging.getLogger(__name__).exception("The sink %r failed to report %r", sink, message)
+
+def _nonblocking(sink):
+    """
+    Returns the `QueueSink` carrying the reports of `sink` made by coroutine functions, so that they never
+    block the event loop.
+
+    A `QueueSink` carries its own reports. `print_sink` reports go through one shared `QueueSink` writing
+    batches to stdout, and the reports of every other sink through one shared `QueueSink` that calls the
+    sink from its background thread. Both are created on first use, and only hold a sink while one of its
+    messages is pending.
+    """
+    if isinstance(sink, QueueSink):
+        return sink
+    kind = "stdout" if sink is print_sink else "dispatch"
+    try:
+        return _background_queues[kind]
+    except KeyError:
+        pass
+    with _background_queues_lock:
+        if kind not in _background_queues:
+            _background_queues[kind] = QueueSink() if kind == "stdout" else QueueSink(target=_deliver)
+        return _background_queues[kind]
+
+def _nonblocking_report(sink):
+    """
+    Returns a sink for wrappers of coroutine functions, forwarding to `sink`, or the default sink, without blocking.
+    """
+    def report(message):
+        emit = sink if sink is not None else _default_sink
+        if emit is silent_sink:
+            return
+        queue = _nonblocking(emit)
+        queue(message if queue is emit or emit is print_sink else (emit, message))
+
+    return report
+
+def _coroutine_function(call):
+    """
+    Returns an `async def` function awaiting the coroutine returned by the synchronous wrapper `call`.
+
+    Frameworks that check `inspect.iscoroutinefunction` still see a coroutine function, and the call
+    only adds the single await of the coroutine of the wrapped function.
+    """
+    @wraps(call)
+    async def inner(*args, **kwargs):
+        return await call(*args, **kwargs)
+
+    return inner
+
+_instrumentation_disabled = os.environ.get("SESSION6_DISABLE", "").strip().lower() in ("1", "true", "yes", "on")
+_enabled_patterns = []
+_skipped = {}
+
+def _enabled_for(fn):
+    name = getattr(fn, "__qualname__", fn.__name__)
+    full_name = f"{fn.__module__}.{name}"
+    return any(fnmatchcase(name, pattern) or fnmatchcase(full_name, pattern) for pattern in _enabled_patterns)
+
+def _skip_instrumentation(fn, redecorate):
+    """
+    Returns True if instrumentation is disabled for `fn`, after recording `redecorate`, a function that
+    instruments its argument as the caller would have, for `enable_instrumentation`.
+    """
+    if not _instrumentation_disabled or _enabled_for(fn):
+        return False
+    try:
+        # Keyed by a weak reference, so that recording a function never keeps it alive.
+        ref = weakref.ref(fn, _forget_skipped)
+    except TypeError:
+        ref = fn
+    _skipped.setdefault(ref, []).append(redecorate)
+    return True
+
+def _forget_skipped(ref):
+    _skipped.pop(ref, None)
+
+def _rebind(fn, decorated):
+    """
+    Replaces `fn` by `decorated` in the module or class that defines it. Returns False if `fn` is not
+    reachable from its module by its qualified name, e.g. if it is defined inside another function.
+    """
+    owner = sys.modules.get(fn.__module__)
+    *path, attr = fn.__qualname__.split(".")
+    for part in path:
+        owner = getattr(owner, part, None)
+    if owner is None or vars(owner).get(attr) is not fn:
+        return False
+    setattr(owner, attr, decorated)
+    return True
+
+def disable_instrumentation():
+    """
+    Makes `checker`, `instrument` and the counter decorators return the function they decorate unchanged,
+    so that decorated functions have no overhead at all. Functions decorated before are left as they are.
+
+    Setting the environment variable SESSION6_DISABLE to 1 before importing session6 has the same effect.
+    """
+    global _instrumentation_disabled
+    _instrumentation_disabled = True
+    _enabled_patterns.clear()
+
+def enable_instrumentation(*patterns):
+    """
+    Re-enables instrumentation, for every function or only for those whose qualified name matches one of
+    `patterns`, and instruments the functions that were left undecorated while it was disabled.
+
+    A pattern is matched with `fnmatch` against the qualified name of the function, e.g. "Users.get",
+    and against it prefixed with its module, e.g. "app.views.*". A function decorated while instrumentation
+    was disabled is decorated again, by the same decorators with the same arguments, and replaced in the
+    module or class that defines it. A function that cannot be replaced, e.g. one defined inside another
+    function, or whose decorators raise, is logged to the `session6` logger and left undecorated, and
+    every later call tries it again.
+
+    Args:
+        *patterns (str): The patterns of the functions to instrument. If none are given, instrumentation is
+            enabled for all functions.
+
+    Returns:
+        list: The qualified names, prefixed with their module, of the functions that were instrumented again.
+    """
+    global _instrumentation_disabled
+    if patterns:
+        _enabled_patterns.extend(patterns)
+    else:
+        _instrumentation_disabled = False
+        _enabled_patterns.clear()
+
+    logger = logging.getLogger(__name__)
+    enabled = []
+    for ref, decorators in list(_skipped.items()):
+        fn = ref() if isinstance(ref, weakref.ref) else ref
+        if fn is None or (_instrumentation_disabled and not _enabled_for(fn)):
+            continue
+        name = f"{fn.__module__}.{fn.__qualname__}"
+        try:
+            decorated = fn
+            for redecorate in decorators:
+                decorated = redecorate(decorated)
+        except Exception:
+            logger.exception("Could not decorate %s again", name)
+            continue
+        if not _rebind(fn, decorated):
+            logger.warning("Could not replace %s, which is not reachable from its module by its qualified name", name)
+            continue
+        # Only forgotten once replaced, so that a function that failed is tried again by the next call.
+        _skipped.pop(ref, None)
+        enabled.append(name)
+    return enabled
+
+def _docstring_error(fn, doc_string, chars=DOCSTRING_MIN_CHARS):
+    """
+    Returns the ValueError message for a docstring that fails the length rule, or None if it passes.
+
+    Spaces are not counted towards the length. They are subtracted with `str.count` instead of being
+    stripped with `str.replace`, so no copy of the docstring is allocated.
+    """
+    if not doc_string:
+        return "The passed function has no docstring."
+    if len(doc_string) - doc_string.count(" ") < chars:
+        return f"Function '{fn.__name__}' requires a docstring longer than {chars} characters."
+    return None
+
+def checker(fn, *, eager=False, revalidate=True, sink=None):
     """
     A closure that checks if a function has a docstring of sufficient length before executing it.
 
@@ -8,8 +354,21 @@ def checker(fn):
     long (excluding spaces). If the docstring meets this requirement, the function is executed. Otherwise,
     a ValueError is raised.
 
+    The docstring verdict is computed once when `fn` is decorated. By default the check is still reported on
+    every call, and a missing or short docstring still raises only when the function is called. With
+    `eager=True` the ValueError is raised at decoration time instead, the check is reported once, and the
+    returned function is a near-zero-overhead passthrough.
+
+    For a coroutine function the returned function is a coroutine function too. The docstring is checked
+    when it is called, and the check is reported through a non-blocking sink so the event loop never waits
+    on stdout.
+
     Args:
         fn (function): The function to be checked and potentially executed.
+        eager (bool): Validate and report at decoration time instead of on every call.
+        revalidate (bool): In eager mode, re-validate if `fn.__doc__` is reassigned. This costs a single
+            identity comparison per call; pass False to skip it entirely.
+        sink (callable): Where the check is reported. Defaults to the sink set with `set_default_sink`.
 
     Raises:
         TypeError: If the passed argument is not a function or is a class type.
@@ -17,6 +376,7 @@ def checker(fn):
 
     Returns:
         function: The inner function that enforces the docstring length check before calling the original function.
+            It has the name and docstring of `fn`, which `__wrapped__` refers to.
 
     Example:
         @checker
@@ -30,15 +390,63 @@ def checker(fn):
         raise TypeError("The passed argument is not a function")
     if isinstance(fn, type):
         raise TypeError("The passed argument is a class type. Please use this closure only for functions")
+    _check_sink(sink)
+    if _skip_instrumentation(fn, lambda target: checker(target, eager=eager, revalidate=revalidate, sink=sink)):
+        return fn
+    is_coroutine = inspect.iscoroutinefunction(fn)
+    if is_coroutine:
+        sink = _nonblocking_report(sink)
+
+    chars = DOCSTRING_MIN_CHARS
+    doc_string = fn.__doc__
+    error = _docstring_error(fn, doc_string, chars)
+
+    if eager:
+        if error:
+            raise ValueError(error)
+        emit = sink if sink is not None else _default_sink
+        if emit is not silent_sink:
+            emit(f"The function {fn.__name__} has a description of more than {chars} characters in its docstring.")
+
+        if not revalidate:
+            @wraps(fn)
+            def passthrough(*args, **kwargs):
+                """
+                Calls the original function `fn`, whose docstring was validated once at decoration time.
+                """
+                return fn(*args, **kwargs)
+
+            return _coroutine_function(passthrough) if is_coroutine else passthrough
 
-    chars = 50
+        @wraps(fn)
+        def validated_call(*args, **kwargs):
+            """
+            Calls the original function `fn`, re-validating its docstring only if `fn.__doc__` was reassigned.
+
+            Raises:
+                ValueError: If the reassigned docstring is missing or shorter than 50 characters.
+
+            Returns:
+                The return value of the original function `fn`.
+            """
+            nonlocal doc_string, error
+            if fn.__doc__ is not doc_string:
+                doc_string = fn.__doc__
+                error = _docstring_error(fn, doc_string, chars)
+            if error:
+                raise ValueError(error)
+            return fn(*args, **kwargs)
+
+        return _coroutine_function(validated_call) if is_coroutine else validated_call
 
+    @wraps(fn)
     def enforce_docstring_length(*args, **kwargs):
         """
         Checks the length of the docstring and executes the function if the docstring is sufficiently long.
 
-        This function checks if the docstring of the function `fn` is longer than 50 characters (excluding spaces).
-        If the docstring is sufficiently long, the function is executed with the provided arguments. If not, a ValueError is raised.
+        The verdict on the docstring of `fn` is computed once at decoration time and only recomputed when
+        `fn.__doc__` has been reassigned since the last call. If the docstring is sufficiently long, the
+        function is executed with the provided arguments. If not, a ValueError is raised.
 
         Raises:
             ValueError: If the function's docstring is missing or shorter than 50 characters.
@@ -46,20 +454,340 @@ def checker(fn):
         Returns:
             The return value of the original function `fn` if it passes the docstring length check.
         """
-        doc_string = fn.__doc__
-        if doc_string:
-            doc_string = doc_string.replace(" ", "")
-            if len(doc_string) < chars:
-                raise ValueError(f"Function '{fn.__name__}' requires a docstring longer than 50 characters.")
+        nonlocal doc_string, error
+        if fn.__doc__ is not doc_string:
+            doc_string = fn.__doc__
+            error = _docstring_error(fn, doc_string, chars)
+        if error:
+            raise ValueError(error)
+        emit = sink if sink is not None else _default_sink
+        if emit is not silent_sink:
+            emit(f"The function {fn.__name__} has a description of more than {chars} characters in its docstring.")
+        return fn(*args, **kwargs)
+
+    return _coroutine_function(enforce_docstring_length) if is_coroutine else enforce_docstring_length
+
+def _module_functions(module):
+    """
+    Yields (qualified name, function) for every function and method defined in `module` itself.
+    """
+    for obj in list(vars(module).values()):
+        if isinstance(obj, CountedFunction):
+            obj = obj.__wrapped__
+        if inspect.isfunction(obj) and obj.__module__ == module.__name__:
+            yield f"{module.__name__}.{obj.__qualname__}", inspect.unwrap(obj)
+        elif inspect.isclass(obj) and obj.__module__ == module.__name__:
+            for attr in list(vars(obj).values()):
+                attr = getattr(attr, "__func__", attr)
+                if isinstance(attr, CountedFunction):
+                    attr = attr.__wrapped__
+                if inspect.isfunction(attr):
+                    yield f"{module.__name__}.{attr.__qualname__}", inspect.unwrap(attr)
+
+def _audit_module(module_name, chars=DOCSTRING_MIN_CHARS):
+    """
+    Imports a module by name and returns the docstring violations of its functions, keyed by qualified name.
+    """
+    module = importlib.import_module(module_name)
+    violations = {}
+    for qualname, fn in _module_functions(module):
+        error = _docstring_error(fn, fn.__doc__, chars)
+        if error:
+            violations[qualname] = error
+    return violations
+
+def audit_docstrings(target, *, processes=None, chars=DOCSTRING_MIN_CHARS):
+    """
+    Validates the docstring of every function of a module or package in one pass, with the rule of `checker`.
+
+    Every function and method defined in `target` (and in all of its submodules if it is a package) is
+    checked up front, instead of `checker` discovering a bad docstring on the first call under traffic.
+
+    Args:
+        target (module or str): The module or package, or its importable name.
+        processes (int): Audit the modules of a package in a process pool of this size. Each worker
+            imports the modules it audits, so this pays off for large codebases only.
+        chars (int): The minimum docstring length, spaces excluded.
+
+    Raises:
+        TypeError: If `target` is neither a module nor a module name.
+
+    Returns:
+        dict: The error message of every failing function, keyed by `module.qualname`. Empty if all pass.
+
+    Example:
+        import mypackage
+        print(audit_docstrings(mypackage))  # Output: {'mypackage.util.helper': 'The passed function has no docstring.'}
+    """
+    import pkgutil
+    from concurrent.futures import ProcessPoolExecutor
+
+    if isinstance(target, str):
+        target = importlib.import_module(target)
+    if not inspect.ismodule(target):
+        raise TypeError("The passed argument is not a module")
+
+    module_names = [target.__name__]
+    if hasattr(target, "__path__"):
+        module_names += [info.name for info in pkgutil.walk_packages(target.__path__, target.__name__ + ".")]
+
+    violations = {}
+    if processes is not None and processes > 1 and len(module_names) > 1:
+        with ProcessPoolExecutor(processes) as pool:
+            for result in pool.map(_audit_module, module_names, [chars] * len(module_names)):
+                violations.update(result)
+    else:
+        for module_name in module_names:
+            violations.update(_audit_module(module_name, chars))
+    return violations
+
+def enforce_docstrings(target, *, processes=None, chars=DOCSTRING_MIN_CHARS):
+    """
+    Audits a module or package with `audit_docstrings` and raises one error listing every violation.
+
+    Call it at import or startup time, so that functions no longer need `checker` on every call.
+
+    Raises:
+        ValueError: If any function's docstring is missing or shorter than `chars` characters.
+    """
+    violations = audit_docstrings(target, processes=processes, chars=chars)
+    if violations:
+        details = "\n".join(f"  {name}: {error}" for name, error in sorted(violations.items()))
+        raise ValueError(f"{len(violations)} function(s) failed the docstring check:\n{details}")
+
+def decorate_module(module, decorator, predicate=None):
+    """
+    Replaces every function defined in `module` with `decorator(function)`, e.g. `decorate_module(mod, checker)`.
+
+    Args:
+        module (module): The module whose functions are decorated in place.
+        decorator (callable): The decorator applied to each function.
+        predicate (callable): If given, only functions for which `predicate(function)` is true are decorated.
+
+    Returns:
+        list: The names of the decorated functions.
+    """
+    decorated = []
+    for name, obj in list(vars(module).items()):
+        if inspect.isfunction(obj) and obj.__module__ == module.__name__ and (predicate is None or predicate(obj)):
+            setattr(module, name, decorator(obj))
+            decorated.append(name)
+    return decorated
+
+def _check_index(n, argument="n"):
+    """
+    Raises a TypeError or ValueError if `n` is not a non-negative integer index into the Fibonacci sequence.
+    """
+    if not isinstance(n, int):
+        raise TypeError(f"The {argument} argument must be an integer")
+    if n < 0:
+        raise ValueError(f"The {argument} argument must not be negative")
+
+def _check_modulus(modulus):
+    """
+    Raises a TypeError or ValueError if `modulus` is not a positive integer.
+    """
+    if not isinstance(modulus, int):
+        raise TypeError("The modulus argument must be an integer")
+    if modulus < 1:
+        raise ValueError("The modulus argument must be at least 1")
+
+def _fibonacci_pair(n, modulus=None):
+    """
+    Returns the pair (F(n), F(n + 1)) using fast doubling, in O(log n) big-integer multiplications.
+
+    Walking the bits of `n` from the most significant one, the pair for k becomes the pair for 2k with
+    F(2k) = F(k) * (2 * F(k + 1) - F(k)) and F(2k + 1) = F(k) ** 2 + F(k + 1) ** 2, then advances one
+    step if the bit is set. With a `modulus`, both numbers are reduced at every step and never grow
+    beyond it.
+    """
+    a, b = 0, 1
+    if modulus is None:
+        for bit in bin(n)[2:]:
+            c = a * (2 * b - a)
+            d = a * a + b * b
+            if bit == "1":
+                a, b = d, c + d
             else:
-                print(f"The function {fn.__name__} has a description of more than {chars} characters in its docstring.")
-                return fn(*args, **kwargs)
+                a, b = c, d
+        return a, b
+    for bit in bin(n)[2:]:
+        c = a * (2 * b - a) % modulus
+        d = (a * a + b * b) % modulus
+        if bit == "1":
+            a, b = d, (c + d) % modulus
         else:
-            raise ValueError(f"The passed function has no docstring.")
+            a, b = c, d
+    return a % modulus, b % modulus
+
+def fibonacci(n, modulus=None):
+    """
+    Returns the Fibonacci number F(n) directly, with F(0) = 0 and F(1) = 1.
+
+    Uses fast doubling, so F(1000000) costs about 20 big-integer multiplications instead of a million
+    calls of the closure returned by `fibonacci_closure`.
+
+    Args:
+        n (int): The index of the Fibonacci number.
+        modulus (int): If given, return F(n) mod `modulus`, computed without ever building F(n).
+
+    Raises:
+        TypeError: If `n` or `modulus` is not an integer.
+        ValueError: If `n` is negative or `modulus` is not positive.
+
+    Returns:
+        int: The Fibonacci number F(n).
+
+    Example:
+        print(fibonacci(10))  # Output: 55
+        print(fibonacci(10, modulus=7))  # Output: 6
+    """
+    _check_index(n)
+    if modulus is not None:
+        _check_modulus(modulus)
+    return _fibonacci_pair(n, modulus)[0]
+
+def fibonacci_mod_array(indices, modulus):
+    """
+    Returns F(i) mod `modulus` for every index i of a NumPy array, in one vectorized pass.
+
+    This is the matrix-power method [[1, 1], [1, 0]] ** i in its fast doubling form, run on all indices at
+    once: one step per bit of the largest index, each step being a handful of whole-array `uint64`
+    operations. Keeping `modulus` below 2 ** 32 guarantees that no product overflows 64 bits.
+
+    Args:
+        indices (numpy.ndarray): The non-negative integer indices, of any shape.
+        modulus (int): The modulus, between 1 and 2 ** 32 - 1.
+
+    Raises:
+        ImportError: If NumPy is not installed.
+        TypeError: If the indices are not integers or `modulus` is not an integer.
+        ValueError: If an index is negative or `modulus` is out of range.
+
+    Returns:
+        numpy.ndarray: An array of `uint64` Fibonacci numbers mod `modulus`, of the same shape as `indices`.
+
+    Example:
+        print(fibonacci_mod_array(numpy.arange(8), 5))  # Output: [0 1 1 2 3 0 3 3]
+    """
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError("fibonacci_mod_array requires NumPy, install it with 'pip install numpy'") from None
+
+    _check_modulus(modulus)
+    if modulus >= 1 << 32:
+        raise ValueError("The modulus argument must be below 2 ** 32")
+    indices = numpy.asarray(indices)
+    if indices.dtype.kind not in "iu":
+        raise TypeError("The indices argument must be an array of integers")
+    if indices.size and indices.min() < 0:
+        raise ValueError("The indices argument must not contain negative indices")
+
+    n = indices.astype(numpy.uint64)
+    m = numpy.uint64(modulus)
+    one = numpy.uint64(1)
+    a = numpy.zeros(n.shape, numpy.uint64)
+    b = numpy.full(n.shape, 1 % modulus, numpy.uint64)
+    bits = int(n.max()).bit_length() if n.size else 0
+    for shift in range(bits - 1, -1, -1):
+        c = a * ((2 * b + m - a) % m) % m
+        d = (a * a % m + b * b % m) % m
+        odd = ((n >> numpy.uint64(shift)) & one).astype(bool)
+        a, b = numpy.where(odd, d, c), numpy.where(odd, (c + d) % m, d)
+    return a
+
+def _fibonacci_chunk(start, stop, modulus=None):
+    """
+    Returns F(start) to F(stop - 1), seeded with (F(start), F(start + 1)) by fast doubling. This runs in the
+    worker processes of `fibonacci_range`. Terms below 2**64 are returned in an `array` of typecode "Q",
+    which is pickled back to the parent as raw bytes.
+    """
+    a, b = _fibonacci_pair(start, modulus)
+    terms = []
+    append = terms.append
+    if modulus is None:
+        for _ in range(stop - start):
+            append(a)
+            a, b = b, a + b
+        return terms
+    for _ in range(stop - start):
+        append(a)
+        a, b = b, (a + b) % modulus
+    return array("Q", terms) if modulus <= 2 ** 64 else terms
+
+def fibonacci_range(start, stop, *, modulus=None, processes=None, chunk_size=None):
+    """
+    Yields the Fibonacci numbers F(start) to F(stop - 1), in order, generating them in parallel across processes.
+
+    The range is split into chunks of `chunk_size` indices. Each chunk is generated by a worker of a process
+    pool, which seeds it with F(low) and F(low + 1) computed by fast doubling and then adds up the following
+    terms, so chunks are independent of each other. At most two chunks per process are in flight: results
+    are streamed back in order as they complete, and memory stays bounded however large the range is.
+
+    Parallelism pays off when the terms are cheap to send back, i.e. with a `modulus`, or for chunks of
+    large indices. Without a modulus the terms grow by 0.7 bits per index, and transferring them to the
+    parent process soon costs more than computing them.
 
-    return enforce_docstring_length
+    Args:
+        start (int): The index of the first term.
+        stop (int): The index after the last term.
+        modulus (int): If given, the terms are reduced modulo `modulus`.
+        processes (int): The number of worker processes. Defaults to the number of CPUs. With 1, the chunks
+            are generated in this process.
+        chunk_size (int): The number of terms per chunk. Defaults to a quarter of the share of each process,
+            between 1,024 and 100,000 terms.
+
+    Raises:
+        TypeError: If `start`, `stop` or `modulus` is not an integer.
+        ValueError: If `start` or `stop` is negative, `stop` is below `start`, `modulus` is not positive, or
+            `processes` or `chunk_size` is below 1.
+
+    Example:
+        for n, term in enumerate(fibonacci_range(10 ** 6, 10 ** 7, modulus=10 ** 9 + 7), 10 ** 6):
+            ...
+    """
+    _check_index(start, "start")
+    _check_index(stop, "stop")
+    if stop < start:
+        raise ValueError("The stop argument must not be below the start argument")
+    if modulus is not None:
+        _check_modulus(modulus)
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if processes < 1:
+        raise ValueError("The processes argument must be at least 1")
+    if chunk_size is None:
+        chunk_size = min(100_000, max(1024, (stop - start) // (4 * processes)))
+    if chunk_size < 1:
+        raise ValueError("The chunk_size argument must be at least 1")
+    return _fibonacci_range(start, stop, modulus, processes, chunk_size)
+
+def _fibonacci_range(start, stop, modulus, processes, chunk_size):
+    lows = range(start, stop, chunk_size)
+    if processes == 1 or len(lows) == 1:
+        for low in lows:
+            yield from _fibonacci_chunk(low, min(low + chunk_size, stop), modulus)
+        return
+
+    from concurrent.futures import ProcessPoolExecutor
 
-def fibonacci_closure():
+    with ProcessPoolExecutor(processes) as pool:
+        pending = deque()
+        lows = iter(lows)
+        try:
+            for low in islice(lows, 2 * processes):
+                pending.append(pool.submit(_fibonacci_chunk, low, min(low + chunk_size, stop), modulus))
+            while pending:
+                chunk = pending.popleft().result()
+                for low in islice(lows, 1):
+                    pending.append(pool.submit(_fibonacci_chunk, low, min(low + chunk_size, stop), modulus))
+                yield from chunk
+        finally:
+            for future in pending:
+                future.cancel()
+
+def fibonacci_closure(modulus=None):
     """
     Returns a closure that generates the next Fibonacci number each time it is called.
 
@@ -68,6 +796,20 @@ def fibonacci_closure():
     number based on the previous two numbers stored in `a` and `b`. The sequence
     starts from 0.
 
+    The closure also has three attributes that move through the sequence faster than one call per term:
+    `take(k)` returns the next k numbers in one call, `skip(k)` advances by k numbers in O(log k) and
+    `seek(n)` moves to index n in O(log n), both using fast doubling.
+
+    With a `modulus`, the closure returns the Fibonacci numbers mod `modulus`, which stay fixed-width
+    instead of growing without bound.
+
+    Args:
+        modulus (int): If given, generate the Fibonacci numbers mod `modulus`.
+
+    Raises:
+        TypeError: If `modulus` is not an integer.
+        ValueError: If `modulus` is not positive.
+
     Returns:
         function: A closure that returns the next Fibonacci number when called.
 
@@ -78,8 +820,13 @@ def fibonacci_closure():
         print(fib())  # Output: 1
         print(fib())  # Output: 2
         print(fib())  # Output: 3
+        print(fib.take(3))  # Output: [5, 8, 13]
+        fib.seek(100)
+        print(fib())  # Output: 354224848179261915075
     """
-    a, b = 0, 1
+    if modulus is not None:
+        _check_modulus(modulus)
+    a, b = _fibonacci_pair(0, modulus)
 
     def next_fibonacci_number(*args, **kwargs):
         """
@@ -102,65 +849,1404 @@ def fibonacci_closure():
         a, b = b, a + b
         return next_val
 
-    return next_fibonacci_number
+    def next_fibonacci_number_mod(*args, **kwargs):
+        """
+        Calculates the next Fibonacci number mod `modulus` based on the previous two values.
 
-func_count={}
+        Raises:
+            ValueError: If any arguments are passed to the function.
 
-def function_counter_with_one_dict(fn):
-    """
-    A decorator that counts how many times a function is called and updates a global dictionary with the counts.
+        Returns:
+            int: The next Fibonacci number mod `modulus` in the sequence.
+        """
+        if args or kwargs:
+            raise ValueError("No arguments should be passed to this function.")
 
-    Args:
-        fn (function): The function to be decorated and counted.
+        nonlocal a, b
+        next_val = a
+        a, b = b, (a + b) % modulus
+        return next_val
 
-    Raises:
-        TypeError: If the passed argument is not a function or if it is a class type.
+    def take(k):
+        """
+        Returns the next `k` Fibonacci numbers as a list, advancing the closure past them.
+        """
+        _check_index(k, "k")
+        nonlocal a, b
+        terms = []
+        append = terms.append
+        x, y = a, b
+        if modulus is None:
+            for _ in range(k):
+                append(x)
+                x, y = y, x + y
+        else:
+            for _ in range(k):
+                append(x)
+                x, y = y, (x + y) % modulus
+        a, b = x, y
+        return terms
 
-    Returns:
-        function: The inner function that wraps the original function and keeps track of the call count.
+    def skip(k):
+        """
+        Advances the closure by `k` Fibonacci numbers without generating them.
 
-    Example:
-        @counter_with_one_dict
-        def add(a, b):
-            return a + b
+        From the current pair (F(i), F(i + 1)), uses F(i + k) = F(i) * F(k - 1) + F(i + 1) * F(k) and
+        F(i + k + 1) = F(i) * F(k) + F(i + 1) * F(k + 1), with F(k) and F(k + 1) from fast doubling.
+        """
+        _check_index(k, "k")
+        nonlocal a, b
+        fk, fk1 = _fibonacci_pair(k, modulus)
+        a, b = a * (fk1 - fk) + b * fk, a * fk + b * fk1
+        if modulus is not None:
+            a, b = a % modulus, b % modulus
 
-        print(add(1, 2))  # Output: add has been called 1 times
-        print(add(3, 4))  # Output: add has been called 2 times
-        print(func_count)  # Output: {'add': 2}
-    """
-    if not callable(fn):
-        raise TypeError("The passed argument is not a function")
-    if isinstance(fn, type):
-        raise TypeError("The passed argument is a class type. Please use this closure only for functions")
+    def seek(n):
+        """
+        Moves the closure to index `n`, so that the next call returns F(n).
+        """
+        _check_index(n)
+        nonlocal a, b
+        a, b = _fibonacci_pair(n, modulus)
 
-    cnt = 0  # initially fn has been run zero times
+    closure = next_fibonacci_number if modulus is None else next_fibonacci_number_mod
+    closure.take = take
+    closure.skip = skip
+    closure.seek = seek
 
-    def inner(*args, **kwargs):
-        nonlocal cnt
-        global func_count
-        inner.__name__ = fn.__name__
-        inner.__doc__ = fn.__doc__
-        cnt += 1
-        func_count[fn.__name__] = cnt
-        print('{0} has been called {1} times'.format(fn.__name__, cnt))
-        return fn(*args, **kwargs)
+    return closure
 
-    def reset_counter():
-        nonlocal cnt
-        cnt = 0
-    inner.reset_counter = reset_counter
+class FibonacciStream:
+    """
+    An iterator over the Fibonacci sequence that streams terms with bounded memory and can be resumed.
 
-    return inner
+    Iterating the stream yields F(index), F(index + 1), ... one term at a time, so it works with
+    `itertools.islice` and `for` loops. For long runs, `chunks(size)` yields the terms in lists (or arrays)
+    of `size` terms built in a tight loop, and `terms()` flattens those chunks, which costs far less per
+    term than calling the closure of `fibonacci_closure`. `state()` captures the position of the stream
+    and `FibonacciStream.from_state` resumes from it.
 
-def function_counter_multi_dict(counter_dict):
-    """
+    Args:
+        index (int): The index of the first term of the stream.
+
+    Example:
+        stream = FibonacciStream()
+        print(list(islice(stream, 5)))  # Output: [0, 1, 1, 2, 3]
+        saved = stream.state()
+        print(next(FibonacciStream.from_state(saved)))  # Output: 5
+    """
+
+    __slots__ = ("index", "_a", "_b")
+
+    def __init__(self, index=0):
+        _check_index(index, "index")
+        self.index = index
+        self._a, self._b = _fibonacci_pair(index)
+
+    @classmethod
+    def from_state(cls, state):
+        """
+        Returns a stream resuming from a state returned by `state()`.
+        """
+        stream = cls.__new__(cls)
+        stream.index, stream._a, stream._b = state
+        return stream
+
+    def state(self):
+        """
+        Returns the position of the stream as a tuple (index, F(index), F(index + 1)).
+        """
+        return (self.index, self._a, self._b)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        a = self._a
+        self._a, self._b = self._b, a + self._b
+        self.index += 1
+        return a
+
+    def chunks(self, size, typecode=None):
+        """
+        Yields the following terms in chunks of `size` terms, without end.
+
+        The stream advances once per chunk, when the chunk is yielded.
+
+        Args:
+            size (int): The number of terms per chunk.
+            typecode (str): If given, chunks are `array.array` buffers of this typecode instead of lists.
+                Only F(0) to F(93) fit in the largest typecode, "Q".
+
+        Raises:
+            ValueError: If `size` is not positive.
+            OverflowError: If a term does not fit in `typecode`. The stream is not advanced past that chunk.
+        """
+        if size < 1:
+            raise ValueError("The size argument must be at least 1")
+        while True:
+            a, b = self._a, self._b
+            chunk = []
+            append = chunk.append
+            for _ in range(size):
+                append(a)
+                a, b = b, a + b
+            if typecode is not None:
+                chunk = array(typecode, chunk)
+            self._a, self._b = a, b
+            self.index += size
+            yield chunk
+
+    def terms(self, chunk_size=1024):
+        """
+        Returns an iterator over the following terms, generated `chunk_size` terms at a time.
+
+        The stream advances a whole chunk at a time, so after stopping part way through a chunk,
+        `state()` points at the end of that chunk.
+        """
+        return chain.from_iterable(self.chunks(chunk_size))
+
+class FibonacciCache:
+    """
+    Random access to Fibonacci numbers with a size-bounded LRU cache of terms and periodic checkpoints.
+
+    `cache[n]` returns F(n). A repeated lookup is served from an LRU cache of the last `maxsize` terms.
+    Otherwise the pair (F(k), F(k + 1)) at the checkpoint k just below `n`, a multiple of
+    `checkpoint_interval`, is computed once with fast doubling and kept, so lookups near an earlier one
+    only walk fewer than `checkpoint_interval` steps. Hit, miss and eviction counts are available
+    from `stats()` for tuning the two sizes.
+
+    Args:
+        maxsize (int): The maximum number of terms kept in the cache.
+        checkpoint_interval (int): The distance between two checkpoints.
+        max_checkpoints (int): The maximum number of checkpoints kept, least recently used ones are evicted.
+
+    Example:
+        cache = FibonacciCache()
+        print(cache[500] == cache[500])  # Output: True
+        print(cache.stats()["hits"])  # Output: 1
+    """
+
+    def __init__(self, maxsize=1024, checkpoint_interval=256, max_checkpoints=1024):
+        if maxsize < 1 or checkpoint_interval < 1 or max_checkpoints < 1:
+            raise ValueError("The maxsize, checkpoint_interval and max_checkpoints arguments must be at least 1")
+        self.maxsize = maxsize
+        self.checkpoint_interval = checkpoint_interval
+        self.max_checkpoints = max_checkpoints
+        self._terms = OrderedDict()
+        self._checkpoints = OrderedDict()
+        self.clear()
+
+    def __getitem__(self, n):
+        terms = self._terms
+        try:
+            value = terms[n]
+        except KeyError:
+            _check_index(n)
+            self.misses += 1
+            value = terms[n] = self._compute(n)
+            if len(terms) > self.maxsize:
+                terms.popitem(last=False)
+                self.evictions += 1
+        else:
+            self.hits += 1
+            terms.move_to_end(n)
+        return value
+
+    def _compute(self, n):
+        base = n - n % self.checkpoint_interval
+        checkpoints = self._checkpoints
+        pair = checkpoints.get(base)
+        if pair is None:
+            self.checkpoint_misses += 1
+            pair = checkpoints[base] = _fibonacci_pair(base)
+            if len(checkpoints) > self.max_checkpoints:
+                checkpoints.popitem(last=False)
+                self.checkpoint_evictions += 1
+        else:
+            self.checkpoint_hits += 1
+            checkpoints.move_to_end(base)
+        a, b = pair
+        for _ in range(n - base):
+            a, b = b, a + b
+        return a
+
+    def stats(self):
+        """
+        Returns the hit, miss and eviction counts of the term cache and of the checkpoints, and their sizes.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "size": len(self._terms),
+            "checkpoint_hits": self.checkpoint_hits,
+            "checkpoint_misses": self.checkpoint_misses,
+            "checkpoint_evictions": self.checkpoint_evictions,
+            "checkpoints": len(self._checkpoints),
+        }
+
+    def clear(self):
+        """
+        Empties the cache and the checkpoints and zeroes the statistics.
+        """
+        self._terms.clear()
+        self._checkpoints.clear()
+        self.hits = self.misses = self.evictions = 0
+        self.checkpoint_hits = self.checkpoint_misses = self.checkpoint_evictions = 0
+
+_HISTOGRAM_SUB_BITS = 3
+_HISTOGRAM_BUCKETS = (64 - _HISTOGRAM_SUB_BITS) << _HISTOGRAM_SUB_BITS
+
+class LatencyHistogram:
+    """
+    A fixed-memory, log-bucketed histogram of call latencies in nanoseconds.
+
+    Every power of two is split into 8 buckets, so a reported quantile is within 6.25% of the true latency.
+    The 488 buckets live in a preallocated `array`, so recording a latency only increments one of them.
+
+    Example:
+        histogram = LatencyHistogram()
+        histogram.record(1500)
+        print(histogram.percentiles())  # Output: {'p50': 1472, 'p95': 1472, 'p99': 1472}
+    """
+
+    __slots__ = ("_buckets", "count", "total_ns")
+
+    def __init__(self):
+        self._buckets = array("Q", bytes(8 * _HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total_ns = 0
+
+    def record(self, ns):
+        """
+        Adds one latency of `ns` nanoseconds to the histogram.
+        """
+        shift = ns.bit_length() - _HISTOGRAM_SUB_BITS - 1
+        if shift > 0:
+            self._buckets[(shift << _HISTOGRAM_SUB_BITS) + (ns >> shift)] += 1
+        else:
+            self._buckets[ns] += 1
+        self.count += 1
+        self.total_ns += ns
+
+    @staticmethod
+    def _bucket_midpoint(index):
+        shift = (index >> _HISTOGRAM_SUB_BITS) - 1
+        if shift <= 0:
+            return index
+        low = (index - (shift << _HISTOGRAM_SUB_BITS)) << shift
+        return low + (1 << shift) // 2
+
+    def quantile(self, q):
+        """
+        Returns the latency in nanoseconds below which a fraction `q` of the recorded calls fall.
+
+        Raises:
+            ValueError: If `q` is not between 0 and 1.
+
+        Returns:
+            int: The midpoint of the bucket holding the quantile, or 0 if nothing was recorded.
+        """
+        if not 0 <= q <= 1:
+            raise ValueError("The quantile must be between 0 and 1")
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self._buckets):
+            seen += count
+            if count and seen >= rank:
+                return self._bucket_midpoint(index)
+        return 0
+
+    def percentiles(self):
+        """
+        Returns the p50, p95 and p99 latencies in nanoseconds.
+        """
+        return {"p50": self.quantile(0.5), "p95": self.quantile(0.95), "p99": self.quantile(0.99)}
+
+    def mean(self):
+        """
+        Returns the mean latency in nanoseconds, or 0.0 if nothing was recorded.
+        """
+        return self.total_ns / self.count if self.count else 0.0
+
+    def reset(self):
+        """
+        Clears every recorded latency.
+        """
+        self._buckets[:] = array("Q", bytes(8 * _HISTOGRAM_BUCKETS))
+        self.count = 0
+        self.total_ns = 0
+
+class ShapeTable:
+    """
+    A bounded table of call counts by argument shape: the types of the positional arguments, and the names
+    and types of the keyword arguments.
+
+    Only the first `maxsize` distinct shapes get their own count. Calls of any later shape are counted in
+    `overflow`, so memory stays bounded whatever the arguments. A shape is a tuple of types built once per
+    call, without formatting any string; shapes are only formatted by `most_common`.
+
+    Args:
+        maxsize (int): The maximum number of distinct shapes counted.
+
+    Example:
+        shapes = ShapeTable()
+        shapes.record((1, 2), {})
+        shapes.record((1.5, 2), {"scale": 3})
+        print(shapes.most_common())  # Output: [('(int, int)', 1), ('(float, int, scale=int)', 1)]
+    """
+
+    __slots__ = ("maxsize", "overflow", "_counts")
+
+    def __init__(self, maxsize=64):
+        if maxsize < 1:
+            raise ValueError("The maxsize argument must be at least 1")
+        self.maxsize = maxsize
+        self.overflow = 0
+        self._counts = {}
+
+    def record(self, args, kwargs):
+        """
+        Counts one call with positional arguments `args` and keyword arguments `kwargs`.
+        """
+        # Building the tuple of types directly is several times faster than tuple(map(type, args)) for the
+        # short argument lists of most calls.
+        arity = len(args)
+        if arity == 2:
+            first, second = args
+            shape = (type(first), type(second))
+        elif arity == 1:
+            shape = (type(args[0]),)
+        elif arity == 0:
+            shape = ()
+        elif arity == 3:
+            first, second, third = args
+            shape = (type(first), type(second), type(third))
+        else:
+            shape = tuple(map(type, args))
+        if kwargs:
+            shape = (shape, tuple(kwargs), tuple(map(type, kwargs.values())))
+        counts = self._counts
+        try:
+            counts[shape] += 1
+        except KeyError:
+            if len(counts) < self.maxsize:
+                counts[shape] = 1
+            else:
+                self.overflow += 1
+
+    @staticmethod
+    def _format(shape):
+        # Types are never tuples, so a shape whose first item is a tuple has keyword arguments.
+        if shape and isinstance(shape[0], tuple):
+            positional, names, types = shape
+            parts = [t.__name__ for t in positional] + [f"{n}={t.__name__}" for n, t in zip(names, types)]
+        else:
+            parts = [t.__name__ for t in shape]
+        return f"({', '.join(parts)})"
+
+    def most_common(self, n=None):
+        """
+        Returns the `n` most frequent shapes, or all of them, as (signature, count) pairs, most frequent first.
+        """
+        ranked = sorted(self._counts.items(), key=lambda item: item[1], reverse=True)[:n]
+        return [(self._format(shape), count) for shape, count in ranked]
+
+    def reset(self):
+        """
+        Clears every recorded shape.
+        """
+        self._counts.clear()
+        self.overflow = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+func_count={}
+func_latency={}
+func_shapes={}
+
+def _counter_key(fn, key):
+    """
+    Returns the key of `fn` in a counter dictionary: its name for `key="name"`, or its module and qualified
+    name for `key="qualname"`, which tells apart functions of the same name in different modules or classes.
+    """
+    if key == "qualname":
+        return f"{fn.__module__}.{getattr(fn, '__qualname__', fn.__name__)}"
+    return fn.__name__
+
+def _check_key(key):
+    if key not in ("name", "qualname"):
+        raise ValueError("The key argument must be 'name' or 'qualname'")
+
+def _coroutine_counter(fn, name, increment, current, sink, histogram, shapes=None):
+    """
+    Returns the inner function of a counter decorator for a coroutine function `fn`.
+
+    The call is counted, timed and reported when its coroutine completes, whether it returns or raises,
+    instead of when the coroutine is created. `increment()` counts the call, returning False if the call
+    was skipped by sampling and should not be reported, and `current()` returns the count to report.
+    Reports go through a non-blocking sink, so the event loop never waits on stdout, and the wrapper adds
+    no await besides the one of the coroutine of `fn`.
+    """
+    report = _nonblocking_report(sink)
+
+    @wraps(fn)
+    async def inner(*args, **kwargs):
+        start = time.perf_counter_ns() if histogram is not None else 0
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            if histogram is not None:
+                histogram.record(time.perf_counter_ns() - start)
+            counted = increment()
+            if shapes is not None and counted is not False:
+                shapes.record(args, kwargs)
+            emit = sink if sink is not None else _default_sink
+            if counted is not False and emit is not silent_sink:
+                report('{0} has been called {1} times'.format(name, current()))
+
+    return inner
+
+def function_counter_with_one_dict(fn, *, sink=None, timing=False, backend=None, key="name", shapes=False):
+    """
+    A decorator that counts how many times a function is called and updates a global dictionary with the counts.
+
+    With `timing=True` the latency of every call is also recorded, with `time.perf_counter_ns`, into a
+    `LatencyHistogram` stored in the global `func_latency` dictionary and in the `latency` attribute of the
+    returned function.
+
+    The name, qualified name, docstring, module and signature of `fn` are copied to the returned function
+    once, with `functools.wraps`, and `fn` is available as its `__wrapped__` attribute.
+
+    If `fn` is a coroutine function, the returned function is one too, and each call is counted, timed and
+    reported when its coroutine completes. Reports are then made through a non-blocking sink.
+
+    Args:
+        fn (function): The function to be decorated and counted.
+        sink (callable): Where each call is reported. Defaults to the sink set with `set_default_sink`.
+        timing (bool): Record the latency of every call.
+        backend (counter backend): Count calls in a backend such as `MappedFileCounter` instead of directly
+            in `func_count`. The totals are written into `func_count` by `backend.sync()`.
+        key (str): How the function is keyed in `func_count` and `func_latency`: "name" by its name, or
+            "qualname" by its module and qualified name, e.g. "app.views.Users.handler", so that functions
+            with the same name do not share a count. The key is computed once, at decoration time.
+        shapes (bool): Count the calls by argument shape into a `ShapeTable` stored in the global
+            `func_shapes` dictionary and in the `shapes` attribute of the returned function.
+
+    Raises:
+        TypeError: If the passed argument is not a function or if it is a class type.
+        ValueError: If `key` is neither "name" nor "qualname".
+
+    Returns:
+        function: The inner function that wraps the original function and keeps track of the call count.
+
+    Example:
+        @counter_with_one_dict
+        def add(a, b):
+            return a + b
+
+        print(add(1, 2))  # Output: add has been called 1 times
+        print(add(3, 4))  # Output: add has been called 2 times
+        print(func_count)  # Output: {'add': 2}
+    """
+    if not callable(fn):
+        raise TypeError("The passed argument is not a function")
+    if isinstance(fn, type):
+        raise TypeError("The passed argument is a class type. Please use this closure only for functions")
+    _check_sink(sink)
+    _check_key(key)
+    if backend is not None and not all(hasattr(backend, attr) for attr in ("register", "increment", "get", "reset")):
+        raise TypeError("The backend argument must provide register, increment, get and reset")
+    if _skip_instrumentation(fn, lambda target: function_counter_with_one_dict(
+            target, sink=sink, timing=timing, backend=backend, key=key, shapes=shapes)):
+        return fn
+
+    name = _counter_key(fn, key)
+    histogram = func_latency.setdefault(name, LatencyHistogram()) if timing else None
+    shapes = func_shapes.setdefault(name, ShapeTable()) if shapes else None
+    if backend is not None:
+        return _backend_counter(fn, name, func_count, backend, sink, histogram, shapes)
+
+    if inspect.iscoroutinefunction(fn):
+        def increment():
+            func_count[name] = func_count.get(name, 0) + 1
+
+        inner = _coroutine_counter(fn, name, increment, lambda: func_count[name], sink, histogram, shapes)
+    else:
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            cnt = func_count.get(name, 0) + 1
+            func_count[name] = cnt
+            emit = sink if sink is not None else _default_sink
+            if emit is not silent_sink:
+                emit('{0} has been called {1} times'.format(name, cnt))
+            if shapes is not None:
+                shapes.record(args, kwargs)
+            if histogram is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+
+    def reset_counter():
+        func_count[name] = 0
+    inner.reset_counter = reset_counter
+    inner.latency = histogram
+    inner.shapes = shapes
+
+    return inner
+
+class _RowLease:
+    """
+    Held in the thread-local state of a counter backend by a thread owning a shard or a row, which is
+    retired or given back when the thread exits and the lease is collected.
+    """
+    __slots__ = ("__weakref__",)
+
+def _retire_shard(counter_ref, shard):
+    counter = counter_ref()
+    if counter is not None:
+        counter._retire(shard)
+
+class ShardedCounter:
+    """
+    A thread-safe counter backend for `function_counter_multi_dict` that never takes a lock per call.
+
+    Every thread increments its own shard, a plain dictionary that only that thread ever writes to, so
+    concurrent calls from a `ThreadPoolExecutor` or a free-threaded build cannot lose counts. Reads sum
+    the shards of all threads. When a thread exits its shard is folded into the totals of exited threads,
+    so that short-lived threads do not accumulate shards. Because totals are only known on read, the
+    counter dictionary passed to `function_counter_multi_dict` is filled in by `sync()` instead of on
+    every call.
+
+    Example:
+        counter = ShardedCounter()
+        counts = {}
+
+        @function_counter_multi_dict(counts, backend=counter)
+        def add(a, b):
+            return a + b
+
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(add, range(1000), range(1000)))
+        counter.sync()
+        print(counts)  # Output: {'add': 1000}
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # The shards of live threads by id, and the totals of the threads that have exited. Both are
+        # replaced together under the lock, so a read never counts a retiring shard twice or not at all.
+        self._state = ({}, {})
+        self._offsets = {}
+        self._bound = []
+
+    def _new_shard(self):
+        shard = {}
+        local = self._local
+        local.counts = shard
+        local.lease = lease = _RowLease()
+        weakref.finalize(lease, _retire_shard, weakref.ref(self), shard).atexit = False
+        with self._lock:
+            shards, retired = self._state
+            self._state = ({**shards, id(shard): shard}, retired)
+        return shard
+
+    def _retire(self, shard):
+        """
+        Folds the shard of an exited thread into the retired totals, so that it is not kept for ever.
+        """
+        with self._lock:
+            shards, retired = self._state
+            shards = {key: live for key, live in shards.items() if live is not shard}
+            retired = dict(retired)
+            for name, count in shard.items():
+                retired[name] = retired.get(name, 0) + count
+            self._state = (shards, retired)
+
+    def register(self, name, counter_dict):
+        """
+        Registers a decorated function, so that `sync()` writes its total into `counter_dict`.
+        """
+        with self._lock:
+            self._bound.append((name, counter_dict))
+
+    def increment(self, name):
+        """
+        Adds one call of `name` to the shard of the calling thread.
+        """
+        try:
+            counts = self._local.counts
+        except AttributeError:
+            counts = self._new_shard()
+        counts[name] = counts.get(name, 0) + 1
+
+    def _raw_total(self, name):
+        shards, retired = self._state
+        return retired.get(name, 0) + sum(shard.get(name, 0) for shard in shards.values())
+
+    def get(self, name):
+        """
+        Returns the number of calls of `name` since it was last reset, summed over all threads.
+        """
+        return self._raw_total(name) - self._offsets.get(name, 0)
+
+    def reset(self, name):
+        """
+        Resets the count of `name` to zero for all threads.
+        """
+        with self._lock:
+            self._offsets[name] = self._raw_total(name)
+
+    def snapshot(self):
+        """
+        Returns a dictionary with the total number of calls of every function counted so far.
+        """
+        shards, retired = self._state
+        totals = dict(retired)
+        for shard in shards.values():
+            for name, count in shard.copy().items():
+                totals[name] = totals.get(name, 0) + count
+        for name, offset in self._offsets.items():
+            totals[name] = totals.get(name, 0) - offset
+        return totals
+
+    def sync(self):
+        """
+        Writes the current totals into the counter dictionaries of the registered functions and returns them.
+        """
+        totals = self.snapshot()
+        for name, counter_dict in self._bound[:]:
+            counter_dict[name] = totals.get(name, 0)
+        return totals
+
+_SLOT_HEADER_BYTES = 64
+_SLOT_NAME_BYTES = 64
+_SLOT_MAGIC = 0x53365F434F554E54
+_SLOT_RETRY_CALLS = 1024
+_slot_tables = weakref.WeakSet()
+
+class _SlotTable:
+    """
+    A fixed-layout table of 64-bit call counts in a shared buffer, with one slot per function name.
+
+    Layout of the buffer, all integers being native 64-bit:
+        header   capacity, rows, registered names, rows holding counts, a reserved word and a magic
+            number, padded to 64 bytes
+        names    `capacity` UTF-8 function names, NUL padded to 64 bytes each
+        offsets  `capacity` counts subtracted from the totals, set by `reset`
+        owners   `rows + 1` ids of the processes owning the rows, 0 for a free row
+        counts   `rows + 1` rows of `capacity` counts
+
+    Every writing thread of every process claims its own row, so an increment is a plain store into
+    memory that no other writer touches: no lock, no syscall and no IPC round-trip per call. A row is
+    given back when its thread exits, and the rows of dead processes are taken over when no row is free.
+    Threads that still find no free row share row 0 under the lock until one is freed. Reads sum a slot
+    over all rows holding counts. Subclasses provide the buffer and a `_lock` shared by all processes,
+    which is only taken to register a name, claim a row, reset a count or write to the shared row.
+    """
+
+    @staticmethod
+    def _size(capacity, rows):
+        return _SLOT_HEADER_BYTES + _SLOT_NAME_BYTES * capacity + 8 * (capacity + (rows + 1) * (capacity + 1))
+
+    def _map(self, buf, capacity=None, rows=None):
+        header = buf[:_SLOT_HEADER_BYTES].cast("q")
+        if capacity is None:
+            if header[5] != _SLOT_MAGIC or len(buf) != self._size(header[0], header[1]):
+                header.release()
+                raise ValueError("The buffer does not hold a counter table")
+            capacity, rows = header[0], header[1]
+        else:
+            header[0], header[1], header[3], header[5] = capacity, rows, 1, _SLOT_MAGIC
+        names_end = _SLOT_HEADER_BYTES + _SLOT_NAME_BYTES * capacity
+        owners_start = names_end + 8 * capacity
+        counts_start = owners_start + 8 * (rows + 1)
+        self.capacity = capacity
+        self.rows = rows
+        self._header = header
+        self._names = buf[_SLOT_HEADER_BYTES:names_end]
+        self._offsets = buf[names_end:owners_start].cast("q")
+        self._owners = buf[owners_start:counts_start].cast("q")
+        self._counts = buf[counts_start:counts_start + 8 * capacity * (rows + 1)].cast("q")
+        self._mapped = True
+        self._slots = {}
+        self._local = threading.local()
+        self._bound = []
+        _slot_tables.add(self)
+
+    def _unmap(self):
+        self._mapped = False
+        for view in (self._header, self._names, self._offsets, self._owners, self._counts):
+            view.release()
+
+    def _name_at(self, slot):
+        return bytes(self._names[slot * _SLOT_NAME_BYTES:(slot + 1) * _SLOT_NAME_BYTES]).rstrip(b"\0").decode()
+
+    def _find_slot(self, padded, registered):
+        for slot in range(registered):
+            if self._names[slot * _SLOT_NAME_BYTES:(slot + 1) * _SLOT_NAME_BYTES] == padded:
+                return slot
+        return None
+
+    def _lookup(self, name):
+        """
+        Returns the slot of `name`, or None if it is not registered. Unlike `_slot`, never writes to the table.
+        """
+        try:
+            return self._slots[name]
+        except KeyError:
+            pass
+        encoded = name.encode()
+        if len(encoded) > _SLOT_NAME_BYTES:
+            return None
+        slot = self._find_slot(encoded.ljust(_SLOT_NAME_BYTES, b"\0"), self._header[2])
+        if slot is not None:
+            self._slots[name] = slot
+        return slot
+
+    def _slot(self, name):
+        try:
+            return self._slots[name]
+        except KeyError:
+            pass
+        encoded = name.encode()
+        if len(encoded) > _SLOT_NAME_BYTES:
+            raise ValueError(f"Function name '{name}' is longer than {_SLOT_NAME_BYTES} bytes")
+        padded = encoded.ljust(_SLOT_NAME_BYTES, b"\0")
+        with self._lock:
+            registered = self._header[2]
+            slot = self._find_slot(padded, registered)
+            if slot is None:
+                if registered == self.capacity:
+                    raise RuntimeError(f"All {self.capacity} slots of the counter table are in use")
+                slot = registered
+                self._names[slot * _SLOT_NAME_BYTES:(slot + 1) * _SLOT_NAME_BYTES] = padded
+                self._header[2] = registered + 1
+        self._slots[name] = slot
+        return slot
+
+    def _free_row(self):
+        owners = self._owners
+        for row in range(1, self.rows + 1):
+            if not owners[row]:
+                return row
+        if os.name == "posix":
+            for row in range(1, self.rows + 1):
+                if not _process_alive(owners[row]):
+                    return row
+        return 0
+
+    def _claim_row(self):
+        pid = os.getpid()
+        with self._lock:
+            row = self._free_row()
+            if row:
+                self._owners[row] = pid
+                if row + 1 > self._header[3]:
+                    self._header[3] = row + 1
+        local = self._local
+        local.base = base = row * self.capacity
+        if row:
+            local.lease = lease = _RowLease()
+            weakref.finalize(lease, _release_slot_row, weakref.ref(self), row, pid).atexit = False
+        else:
+            # Look for a free row again after this many calls on the shared row.
+            local.retry = _SLOT_RETRY_CALLS
+        return base
+
+    def _raw_total(self, slot):
+        return sum(self._counts[slot:self._header[3] * self.capacity:self.capacity])
+
+    def register(self, name, counter_dict):
+        """
+        Registers a decorated function, so that `sync()` writes its total into `counter_dict`.
+        """
+        self._slot(name)
+        self._bound.append((name, counter_dict))
+
+    def increment(self, name):
+        """
+        Adds one call of `name` to the row of the calling thread.
+        """
+        try:
+            base = self._local.base
+        except AttributeError:
+            base = self._claim_row()
+        try:
+            slot = self._slots[name]
+        except KeyError:
+            slot = self._slot(name)
+        if base:
+            self._counts[base + slot] += 1
+            return
+        with self._lock:
+            self._counts[slot] += 1
+        local = self._local
+        local.retry -= 1
+        if not local.retry:
+            del local.base
+
+    def get(self, name):
+        """
+        Returns the number of calls of `name` since it was last reset, summed over all threads and processes,
+        or 0 if `name` was never registered.
+        """
+        slot = self._lookup(name)
+        if slot is None:
+            return 0
+        return self._raw_total(slot) - self._offsets[slot]
+
+    def reset(self, name):
+        """
+        Resets the count of `name` to zero for all threads and processes.
+        """
+        slot = self._slot(name)
+        with self._lock:
+            self._offsets[slot] = self._raw_total(slot)
+
+    def snapshot(self):
+        """
+        Returns a dictionary with the total number of calls of every registered function.
+
+        The whole table is copied with a single read, then summed per function.
+        """
+        capacity = self.capacity
+        registered = self._header[2]
+        counts = self._counts[:self._header[3] * capacity].tolist()
+        offsets = self._offsets.tolist()
+        return {self._name_at(slot): sum(counts[slot::capacity]) - offsets[slot] for slot in range(registered)}
+
+    def sync(self):
+        """
+        Writes the current totals into the counter dictionaries of the functions registered in this process.
+        """
+        totals = self.snapshot()
+        for name, counter_dict in self._bound[:]:
+            counter_dict[name] = totals.get(name, 0)
+        return totals
+
+def _release_slot_row(table_ref, row, pid):
+    table = table_ref()
+    # Forked children drop the leases of their parent's threads, whose rows are still in use.
+    if table is not None and table._mapped and os.getpid() == pid and table._owners[row] == pid:
+        table._owners[row] = 0
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _forget_slot_rows():
+    """
+    Makes every thread of a forked child claim a new row instead of writing to the row of its parent.
+    """
+    for table in list(_slot_tables):
+        table._local = threading.local()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_forget_slot_rows)
+
+class SharedMemoryCounter(_SlotTable):
+    """
+    A multi-process counter backend for `function_counter_multi_dict` in `multiprocessing.shared_memory`.
+
+    Increments from every process are visible to all of them without any IPC round-trip per call. The counter
+    is shared with worker processes by inheritance: create it before forking (e.g. in the gunicorn master), or
+    pass it in `initargs` of a `ProcessPoolExecutor`. `snapshot()` returns the totals of all functions.
+
+    Args:
+        capacity (int): The number of function names the table can hold.
+        rows (int): The number of threads, over all processes, that can write to the table at once without
+            a lock. Further threads share one row under the lock.
+        name (str): The name of the shared memory block. Defaults to a random name.
+        context (multiprocessing.context.BaseContext): The multiprocessing context of the worker processes,
+            used to create the lock guarding registrations. Defaults to the default context.
+
+    Example:
+        counter = SharedMemoryCounter()
+
+        @function_counter_multi_dict(counts, backend=counter)
+        def handler(request):
+            ...
+
+        with ProcessPoolExecutor(4) as pool:
+            list(pool.map(handler, requests))
+        print(counter.snapshot())  # Output: {'handler': 1000}
+    """
+
+    def __init__(self, capacity=1024, rows=64, name=None, context=None):
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        if capacity < 1 or rows < 1:
+            raise ValueError("The capacity and rows arguments must be at least 1")
+        self._shm = shared_memory.SharedMemory(name=name, create=True, size=self._size(capacity, rows))
+        self._lock = (context if context is not None else multiprocessing).Lock()
+        self._map(self._shm.buf, capacity, rows)
+
+    @property
+    def name(self):
+        """
+        The name of the shared memory block.
+        """
+        return self._shm.name
+
+    def __getstate__(self):
+        return {"name": self._shm.name, "lock": self._lock}
+
+    def __setstate__(self, state):
+        from multiprocessing import shared_memory
+
+        self._shm = shared_memory.SharedMemory(name=state["name"])
+        self._lock = state["lock"]
+        self._map(self._shm.buf)
+
+    def close(self):
+        """
+        Detaches this process from the shared memory block.
+        """
+        self._unmap()
+        self._shm.close()
+
+    def unlink(self):
+        """
+        Destroys the shared memory block. Call it once, from the process that created the counter.
+        """
+        self._shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        self.unlink()
+
+class MappedFileCounter(_SlotTable):
+    """
+    A persistent counter backend for the counter decorators in a memory-mapped file.
+
+    The file holds the fixed-layout table of `SharedMemoryCounter`, so an increment is a store into the
+    page cache, without any syscall. The operating system writes the pages back even if the process
+    crashes, and a background thread flushes them to disk every `flush_interval` seconds, so that at most
+    that much is lost if the machine itself goes down. Reopening the file resumes the totals: the threads of
+    the new process write on top of the rows of the previous one.
+
+    The file has a single writer process at a time, which holds an exclusive lock on it where `fcntl` is
+    available. Any number of processes can open it with `readonly=True` to report on it with `snapshot()`.
+
+    Args:
+        path (str): The path of the file, created if it does not exist.
+        capacity (int): The number of function names the table can hold, when creating the file.
+        rows (int): The number of threads that can write to the table at once without a lock, when creating the file.
+        flush_interval (float): The number of seconds between flushes to disk, or None to only flush in
+            `flush()` and `close()`.
+        readonly (bool): Open an existing file for reading only.
+
+    Raises:
+        ValueError: If the file exists but does not hold a counter table.
+        RuntimeError: If another process has the file open for writing.
+
+    Example:
+        counter = MappedFileCounter("counts.bin")
+
+        @function_counter_multi_dict(counts, backend=counter)
+        def handler(request):
+            ...
+
+        # After a restart, or in another process:
+        print(MappedFileCounter("counts.bin", readonly=True).snapshot())  # Output: {'handler': 1000}
+    """
+
+    def __init__(self, path, capacity=1024, rows=64, flush_interval=1.0, readonly=False):
+        import mmap
+        try:
+            import fcntl
+        except ImportError:  # Windows
+            fcntl = None
+
+        if capacity < 1 or rows < 1:
+            raise ValueError("The capacity and rows arguments must be at least 1")
+        if flush_interval is not None and flush_interval <= 0:
+            raise ValueError("The flush_interval argument must be positive")
+        self.path = os.fspath(path)
+        self.readonly = readonly
+        self._lock = threading.Lock()
+        self._file = open(self.path, "rb" if readonly else "a+b")
+        try:
+            if not readonly and fcntl is not None:
+                try:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    raise RuntimeError(f"{self.path} is open for writing in another process") from None
+            created = os.fstat(self._file.fileno()).st_size == 0
+            if created:
+                if readonly:
+                    raise ValueError(f"{self.path} does not hold a counter table")
+                self._file.truncate(self._size(capacity, rows))
+            access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=access)
+            self._buf = memoryview(self._mmap)
+            try:
+                if created:
+                    self._map(self._buf, capacity, rows)
+                else:
+                    self._map(self._buf)
+            except ValueError:
+                self._buf.release()
+                self._mmap.close()
+                raise ValueError(f"{self.path} does not hold a counter table") from None
+        except BaseException:
+            self._file.close()
+            raise
+        if not readonly:
+            # The rows of the previous writer are reused, so restarts never run out of rows.
+            for row in range(1, self.rows + 1):
+                self._owners[row] = 0
+        self._closed = threading.Event()
+        if not readonly and flush_interval is not None:
+            threading.Thread(target=self._flush_periodically, args=(flush_interval,), daemon=True).start()
+
+    def _flush_periodically(self, interval):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the counts to disk.
+        """
+        if not self.readonly and not self._closed.is_set():
+            self._mmap.flush()
+
+    def close(self):
+        """
+        Flushes the counts and closes the file. The counter cannot be used afterwards.
+        """
+        if self._closed.is_set():
+            return
+        self.flush()
+        self._closed.set()
+        self._unmap()
+        self._buf.release()
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _backend_counter(fn, name, counter_dict, backend, sink, histogram, shapes=None):
+    """
+    Returns the inner function of `function_counter_multi_dict` for a counter backend such as `ShardedCounter`.
+    """
+    increment = backend.increment
+    backend.register(name, counter_dict)
+
+    if inspect.iscoroutinefunction(fn):
+        inner = _coroutine_counter(fn, name, lambda: increment(name), lambda: backend.get(name), sink, histogram, shapes)
+    else:
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            increment(name)
+            emit = sink if sink is not None else _default_sink
+            if emit is not silent_sink:
+                emit('{0} has been called {1} times'.format(name, backend.get(name)))
+            if shapes is not None:
+                shapes.record(args, kwargs)
+            if histogram is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+
+    def reset_counter():
+        """
+        This resets the counter on the functions to zero.
+        """
+        backend.reset(name)
+        counter_dict[name] = 0
+
+    inner.reset_counter = reset_counter
+    inner.latency = histogram
+    inner.shapes = shapes
+
+    return inner
+
+def _geometric_gap(sample):
+    """
+    Returns the number of calls up to and including the next sampled one, when each call is sampled with
+    probability 1 / `sample`.
+    """
+    if sample == 1:
+        return 1
+    return int(math.log(1.0 - random.random()) / math.log(1.0 - 1.0 / sample)) + 1
+
+def _sampled_counter(fn, name, counter_dict, sample, stride, sink, histogram, shapes=None):
+    """
+    Returns the inner function of `function_counter_multi_dict` in sampling mode.
+
+    Calls that are not sampled only decrement a countdown before calling `fn`. A sampled call adds `sample`
+    to the count, reports it, records its argument shape and latency and restarts the countdown, either at
+    `sample` (stride) or at a geometrically distributed gap (random).
+
+    Under threads, any call that finds the countdown at or below zero restarts it, so a race can never
+    stop the sampling, and the rare sampled calls update the count under a lock. The decrement is not
+    locked: the error bounds of both modes hold with any number of threads on CPython with the GIL, which
+    in practice never switches threads in the middle of it. On a free-threaded build concurrent decrements
+    can be lost, which delays the sampled calls, so the count can fall short of the true number of calls.
+    """
+    countdown = 1 if stride else _geometric_gap(sample)
+    lock = threading.Lock()
+
+    def increment():
+        nonlocal countdown
+        countdown -= 1
+        if countdown > 0:
+            return False
+        countdown = sample if stride else _geometric_gap(sample)
+        with lock:
+            counter_dict[name] = counter_dict.get(name, 0) + sample
+        return True
+
+    if inspect.iscoroutinefunction(fn):
+        inner = _coroutine_counter(fn, name, increment, lambda: counter_dict.get(name, 0), sink, histogram, shapes)
+    else:
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            nonlocal countdown
+            countdown -= 1
+            if countdown > 0:
+                return fn(*args, **kwargs)
+            countdown = sample if stride else _geometric_gap(sample)
+            with lock:
+                cnt = counter_dict.get(name, 0) + sample
+                counter_dict[name] = cnt
+            emit = sink if sink is not None else _default_sink
+            if emit is not silent_sink:
+                emit('{0} has been called {1} times'.format(name, cnt))
+            if shapes is not None:
+                shapes.record(args, kwargs)
+            if histogram is None:
+                return fn(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                histogram.record(time.perf_counter_ns() - start)
+
+    def reset_counter():
+        """
+        This resets the counter on the functions to zero.
+        """
+        counter_dict[name] = 0
+
+    inner.reset_counter = reset_counter
+    inner.latency = histogram
+    inner.shapes = shapes
+
+    return inner
+
+class _WrappedAttribute(str):
+    """
+    A class attribute of `CountedFunction` that reads the same attribute of the wrapped function on an
+    instance. Being a string, it is still the value of the attribute on the class itself.
+    """
+
+    def __new__(cls, name, value):
+        self = super().__new__(cls, value)
+        self.name = name
+        return self
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return getattr(instance.__wrapped__, self.name)
+
+class CountedFunction:
+    """
+    The callable returned by `function_counter_multi_dict` with `compact=True` for a regular function.
+
+    It holds the function, the counter dictionary, the sink, the latency histogram and the shape table in
+    `__slots__`, so a decorated function costs a single small object instead of two closures, their cells
+    and the `__dict__` of a function. Name, qualified name and `__wrapped__` are stored on the object; the
+    docstring, module and any other attribute are read from the wrapped function. It binds as a method
+    like a function.
+
+    Args:
+        fn (function): The function to count.
+        counter_dict (dict): The dictionary holding the call counts, by function name.
+        sink (callable): Where each call is reported, or None for the default sink.
+        histogram (LatencyHistogram): Where the latency of each call is recorded, or None.
+        key (str): The key of the function in `counter_dict`. Defaults to its name.
+        shapes (ShapeTable): Where the argument shape of each call is counted, or None.
+    """
+    __slots__ = (
+        "__wrapped__", "__name__", "__qualname__", "_key", "_counter_dict", "_sink", "latency", "shapes", "__weakref__",
+    )
+    __doc__ = _WrappedAttribute("__doc__", __doc__)
+    __module__ = _WrappedAttribute("__module__", __module__)
+
+    def __init__(self, fn, counter_dict, sink=None, histogram=None, key=None, shapes=None):
+        self.__wrapped__ = fn
+        self.__name__ = fn.__name__
+        self.__qualname__ = getattr(fn, "__qualname__", fn.__name__)
+        self._key = fn.__name__ if key is None else key
+        self._counter_dict = counter_dict
+        self._sink = sink
+        self.latency = histogram
+        self.shapes = shapes
+
+    def __call__(self, *args, **kwargs):
+        name = self._key
+        counter_dict = self._counter_dict
+        cnt = counter_dict.get(name, 0) + 1
+        counter_dict[name] = cnt
+        sink = self._sink
+        emit = sink if sink is not None else _default_sink
+        if emit is not silent_sink:
+            emit('{0} has been called {1} times'.format(name, cnt))
+        shapes = self.shapes
+        if shapes is not None:
+            shapes.record(args, kwargs)
+        histogram = self.latency
+        if histogram is None:
+            return self.__wrapped__(*args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+            return self.__wrapped__(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+
+    def reset_counter(self):
+        """
+        This resets the counter on the functions to zero.
+        """
+        self._counter_dict[self._key] = 0
+
+    def __get__(self, instance, owner=None):
+        if instance is None:
+            return self
+        return MethodType(self, instance)
+
+    def __getattr__(self, name):
+        if name == "__wrapped__":
+            raise AttributeError(name)
+        return getattr(self.__wrapped__, name)
+
+    def __reduce__(self):
+        # Pickled by reference, like the module-level function it replaces.
+        return self.__qualname__
+
+    def __repr__(self):
+        return f"<counted function {self.__qualname__}>"
+
+class _ResetCounter:
+    """
+    The `reset_counter` attribute of a function counted by `function_counter_multi_dict`, which resets its
+    count to zero when called.
+
+    It also holds, in `__slots__`, the state read by the wrapper on every call, so that the wrapper closes
+    over this single object instead of one cell per value and needs no separate `reset_counter` closure.
+    """
+    __slots__ = ("key", "counter_dict", "sink", "histogram", "shapes")
+
+    def __init__(self, counter_dict, key, sink, histogram, shapes):
+        self.key = key
+        self.counter_dict = counter_dict
+        self.sink = sink
+        self.histogram = histogram
+        self.shapes = shapes
+
+    def __call__(self):
+        self.counter_dict[self.key] = 0
+
+def _dict_counter(fn, name, counter_dict, sink, histogram, shapes):
+    """
+    Returns the inner function of `function_counter_multi_dict` for a regular function counted in `counter_dict`.
+    """
+    state = _ResetCounter(counter_dict, name, sink, histogram, shapes)
+
+    @wraps(fn)
+    def inner(*args, **kwargs):
+        name = state.key
+        counter_dict = state.counter_dict
+        cnt = counter_dict.get(name, 0) + 1
+        counter_dict[name] = cnt
+        sink = state.sink
+        emit = sink if sink is not None else _default_sink
+        if emit is not silent_sink:
+            emit('{0} has been called {1} times'.format(name, cnt))
+        shapes = state.shapes
+        if shapes is not None:
+            shapes.record(args, kwargs)
+        histogram = state.histogram
+        if histogram is None:
+            return fn(*args, **kwargs)
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            histogram.record(time.perf_counter_ns() - start)
+
+    inner.reset_counter = state
+    inner.latency = histogram
+    inner.shapes = shapes
+
+    return inner
+
+def function_counter_multi_dict(counter_dict, *, sink=None, backend=None, latency_dict=None, sample=None, sampling="stride",
+                                key="name", shape_dict=None, compact=False):
+    """
     A decorator factory that counts how many times a function is called and updates a specified dictionary with the counts.
 
+    A regular function is wrapped in a closure over a single slotted object holding the counter state,
+    which also serves as its `reset_counter`. With `compact=True` it is wrapped in a `CountedFunction`
+    instead, which stores the name and qualified name of the function and reads its other attributes from
+    it, so that each decorated function costs about a hundred bytes instead of about six hundred, at the
+    price of a slower call through `__call__`. Coroutine functions are counted on completion, as described
+    for `function_counter_with_one_dict`.
+
     Args:
         counter_dict (dict): The dictionary to be updated with the function call counts.
+        sink (callable): Where each call is reported. Defaults to the sink set with `set_default_sink`.
+        backend (ShardedCounter, SharedMemoryCounter or MappedFileCounter): Count calls in this backend
+            instead of directly in `counter_dict`. The totals are written into `counter_dict` by `backend.sync()`.
+        latency_dict (dict): Record the latency of every call into a `LatencyHistogram` stored in this
+            dictionary under the function name, and in the `latency` attribute of the returned function.
+        sample (int): Only count 1 in `sample` calls, adding `sample` to the count each time, so that the
+            count is an extrapolation of the true number of calls. Latencies are only recorded for the
+            sampled calls. Cannot be combined with a backend.
+        sampling (str): "stride" samples every `sample`-th call, starting with the first, so the count
+            exceeds the true number of calls by less than `sample`. "random" samples each call
+            independently with probability 1 / `sample`, drawing the gap to the next sampled call from a
+            geometric distribution; the count is then unbiased, with a standard deviation of
+            sqrt(calls * (sample - 1)).
+        key (str): How the function is keyed in `counter_dict` and `latency_dict`: "name" or "qualname",
+            as described for `function_counter_with_one_dict`.
+        shape_dict (dict): Count the calls by argument shape into a `ShapeTable` stored in this dictionary
+            under the function name, and in the `shapes` attribute of the returned function. With sampling,
+            only the sampled calls are counted.
+        compact (bool): Return a `CountedFunction` for a regular function, for when tens of thousands of
+            functions are decorated and memory matters more than the time of a call. Ignored with a backend,
+            sampling or a coroutine function.
 
     Raises:
         TypeError: If the passed argument is not a function or if it is a class type.
+        ValueError: If `sample` is not positive, `sampling` or `key` is unknown, or sampling is combined with
+            a backend.
 
     Returns:
         function: A decorator that wraps the original function and keeps track of the call count.
@@ -177,32 +2263,634 @@ def function_counter_multi_dict(counter_dict):
     """
     if not isinstance(counter_dict, dict):
         raise TypeError("The counter_dict argument must be a dictionary")
+    _check_sink(sink)
+    _check_key(key)
+    if backend is not None and not all(hasattr(backend, attr) for attr in ("register", "increment", "get", "reset")):
+        raise TypeError("The backend argument must provide register, increment, get and reset")
+    if latency_dict is not None and not isinstance(latency_dict, dict):
+        raise TypeError("The latency_dict argument must be a dictionary")
+    if shape_dict is not None and not isinstance(shape_dict, dict):
+        raise TypeError("The shape_dict argument must be a dictionary")
+    if sample is not None:
+        if not isinstance(sample, int) or sample < 1:
+            raise ValueError("The sample argument must be a positive integer")
+        if sampling not in ("stride", "random"):
+            raise ValueError("The sampling argument must be 'stride' or 'random'")
+        if backend is not None:
+            raise ValueError("Sampling cannot be combined with a counter backend")
 
     def decorator(fn):
         if not callable(fn):
             raise TypeError("The passed argument is not a function")
         if isinstance(fn, type):
             raise TypeError("The passed argument is a class type. Please use this decorator only for functions")
+        if _skip_instrumentation(fn, decorator):
+            return fn
+        name = _counter_key(fn, key)
+        histogram = None if latency_dict is None else latency_dict.setdefault(name, LatencyHistogram())
+        shapes = None if shape_dict is None else shape_dict.setdefault(name, ShapeTable())
+        if backend is not None:
+            return _backend_counter(fn, name, counter_dict, backend, sink, histogram, shapes)
+        if sample is not None:
+            return _sampled_counter(fn, name, counter_dict, sample, sampling == "stride", sink, histogram, shapes)
+        if not inspect.iscoroutinefunction(fn):
+            if compact:
+                return CountedFunction(fn, counter_dict, sink, histogram, name, shapes)
+            return _dict_counter(fn, name, counter_dict, sink, histogram, shapes)
 
-        cnt = 0  # initially fn has been run zero times
+        def increment():
+            counter_dict[name] = counter_dict.get(name, 0) + 1
 
-        def inner(*args, **kwargs):
-            nonlocal cnt
-            inner.__name__ = fn.__name__
-            inner.__doc__ = fn.__doc__
-            cnt += 1
-            counter_dict[fn.__name__] = cnt
-            print('{0} has been called {1} times'.format(fn.__name__, cnt))
-            return fn(*args, **kwargs)
+        inner = _coroutine_counter(fn, name, increment, lambda: counter_dict[name], sink, histogram, shapes)
+
+        def reset_counter():
+            """
+            This resets the counter on the functions to zero.
+            """
+            counter_dict[name] = 0
+        inner.reset_counter = reset_counter
+        inner.latency = histogram
+        inner.shapes = shapes
+
+        return inner
+
+    return decorator
+
+def instrument(*, docstring=True, eager=False, counter_dict=None, latency_dict=None, sink=None, key="name"):
+    """
+    A decorator factory that fuses the docstring check of `checker`, the call counting of
+    `function_counter_multi_dict` and latency timing into a single wrapper.
+
+    Stacking `checker` on a counter runs two wrapper frames per call, each repacking `*args, **kwargs` and
+    making its own report. The fused wrapper checks, counts, reports and times in one frame, passes the
+    arguments through once and makes a single report per call, holding the messages of both decorators.
+    Each behaviour is optional, and the docstring verdict is cached as in `checker`.
+
+    Args:
+        docstring (bool): Check that the docstring of the function is longer than 50 characters.
+        eager (bool): Raise for a short docstring at decoration time and report the check once, instead of
+            raising and reporting on every call, as with `checker(fn, eager=True)`.
+        counter_dict (dict): Count the calls in this dictionary. Calls are not counted if None.
+        latency_dict (dict): Record the latency of every call into a `LatencyHistogram` stored in this
+            dictionary. Calls are not timed if None.
+        sink (callable): Where each call is reported. Defaults to the sink set with `set_default_sink`.
+        key (str): How the function is keyed in `counter_dict` and `latency_dict`: "name" or "qualname".
+
+    Raises:
+        TypeError: If the passed argument is not a function or if it is a class type.
+        ValueError: If `key` is unknown, or in eager mode, if the docstring is missing or too short.
+
+    Returns:
+        function: A decorator that wraps the original function in a single instrumented wrapper.
+
+    Example:
+        @instrument(counter_dict=counts, latency_dict=latencies)
+        def add(a, b):
+            \"\"\"This function adds two numbers of any type and returns their sum.\"\"\"
+            return a + b
+
+        add(1, 2)
+        # Output: The function add has a description of more than 50 characters in its docstring.
+        #         add has been called 1 times
+    """
+    if counter_dict is not None and not isinstance(counter_dict, dict):
+        raise TypeError("The counter_dict argument must be a dictionary")
+    if latency_dict is not None and not isinstance(latency_dict, dict):
+        raise TypeError("The latency_dict argument must be a dictionary")
+    _check_sink(sink)
+    _check_key(key)
+
+    def decorator(fn):
+        if not callable(fn):
+            raise TypeError("The passed argument is not a function")
+        if isinstance(fn, type):
+            raise TypeError("The passed argument is a class type. Please use this decorator only for functions")
+        if _skip_instrumentation(fn, decorator):
+            return fn
+        is_coroutine = inspect.iscoroutinefunction(fn)
+        report = _nonblocking_report(sink) if is_coroutine else sink
+        chars = DOCSTRING_MIN_CHARS
+        name = _counter_key(fn, key)
+        histogram = None if latency_dict is None else latency_dict.setdefault(name, LatencyHistogram())
+        doc_string = fn.__doc__
+        error = _docstring_error(fn, doc_string, chars) if docstring else None
+        checked = f"The function {fn.__name__} has a description of more than {chars} characters in its docstring."
+
+        if eager and docstring:
+            if error:
+                raise ValueError(error)
+            emit = report if report is not None else _default_sink
+            if emit is not silent_sink:
+                emit(checked)
+        prefix = checked + "\n" if docstring and not eager else ""
+        per_call = checked if docstring and not eager else None
+
+        def message(emit):
+            """
+            Counts a call of a coroutine function and returns the report to make for it, if any.
+            """
+            if counter_dict is None:
+                return per_call
+            cnt = counter_dict.get(name, 0) + 1
+            counter_dict[name] = cnt
+            if emit is silent_sink:
+                return None
+            return '{0}{1} has been called {2} times'.format(prefix, name, cnt)
+
+        if is_coroutine:
+            @wraps(fn)
+            async def inner(*args, **kwargs):
+                nonlocal doc_string, error
+                if docstring and fn.__doc__ is not doc_string:
+                    doc_string = fn.__doc__
+                    error = _docstring_error(fn, doc_string, chars)
+                if error:
+                    raise ValueError(error)
+                start = time.perf_counter_ns() if histogram is not None else 0
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    if histogram is not None:
+                        histogram.record(time.perf_counter_ns() - start)
+                    emit = report if report is not None else _default_sink
+                    text = message(emit)
+                    if text is not None and emit is not silent_sink:
+                        emit(text)
+        else:
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                nonlocal doc_string, error
+                if docstring and fn.__doc__ is not doc_string:
+                    doc_string = fn.__doc__
+                    error = _docstring_error(fn, doc_string, chars)
+                if error:
+                    raise ValueError(error)
+                emit = sink if sink is not None else _default_sink
+                if counter_dict is not None:
+                    cnt = counter_dict.get(name, 0) + 1
+                    counter_dict[name] = cnt
+                    if emit is not silent_sink:
+                        emit('{0}{1} has been called {2} times'.format(prefix, name, cnt))
+                elif per_call is not None and emit is not silent_sink:
+                    emit(per_call)
+                if histogram is None:
+                    return fn(*args, **kwargs)
+                start = time.perf_counter_ns()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.record(time.perf_counter_ns() - start)
 
         def reset_counter():
             """
             This resets the counter on the functions to zero.
             """
-            nonlocal cnt
-            cnt = 0
+            if counter_dict is not None:
+                counter_dict[name] = 0
+        inner.reset_counter = reset_counter
+        inner.latency = histogram
+
+        return inner
+
+    return decorator
+
+_KWARGS_MARK = object()
+_CACHE_MISS = object()
+_FAST_KEY_TYPES = {int, str}
+
+def _memo_key(args, kwargs):
+    """
+    Returns the cache key of a call. Without keyword arguments the `args` tuple is the key, so zero- and
+    one-argument calls build no new tuple, and a single int or str argument is its own key.
+    """
+    if kwargs:
+        return args + (_KWARGS_MARK,) + tuple(kwargs.items())
+    if len(args) == 1 and type(args[0]) in _FAST_KEY_TYPES:
+        return args[0]
+    return args
+
+def memoize(counter_dict, *, maxsize=128, ttl=None, sink=None, key="name"):
+    """
+    A decorator factory that caches the results of a function and counts the cache hits and misses.
+
+    Results are kept in an LRU cache of at most `maxsize` entries, each expiring `ttl` seconds after it was
+    computed. An expired entry is dropped when it is next looked up, or when it is the least recently used.
+    The counts are written into `counter_dict` under the keys "<name>.hits" and "<name>.misses", and each
+    call is reported to the sink. The cache is guarded by a lock, which is never held while the function
+    runs, so concurrent misses for the same arguments may each call it.
+
+    Arguments must be hashable. A call with only positional arguments is keyed by its `args` tuple as is,
+    and a call with a single int or str argument by that argument, as `functools.lru_cache` does.
+
+    If `fn` is a coroutine function, the returned function is one too, and the awaited results are cached.
+
+    Args:
+        counter_dict (dict): The dictionary to be updated with the hit and miss counts.
+        maxsize (int): The maximum number of cached results, or None for no limit.
+        ttl (float): The number of seconds a result stays valid, or None to keep it until it is evicted.
+        sink (callable): Where each call is reported. Defaults to the sink set with `set_default_sink`.
+        key (str): How the function is keyed in `counter_dict`: "name" or "qualname".
+
+    Raises:
+        TypeError: If the passed argument is not a function or if it is a class type.
+        ValueError: If `maxsize` or `ttl` is not positive, or `key` is unknown.
+
+    Returns:
+        function: A decorator that wraps the original function with the cache. The returned function has
+        `cache_info()`, `cache_clear()` and `reset_counter()` attributes.
+
+    Example:
+        cache_count = {}
+        @memoize(cache_count, maxsize=1024, ttl=60)
+        def square(x):
+            return x * x
+
+        square(3)  # Output: square has been called 1 times, 0 from the cache
+        square(3)  # Output: square has been called 2 times, 1 from the cache
+        print(cache_count)  # Output: {'square.misses': 1, 'square.hits': 1}
+    """
+    if not isinstance(counter_dict, dict):
+        raise TypeError("The counter_dict argument must be a dictionary")
+    if maxsize is not None and (not isinstance(maxsize, int) or maxsize < 1):
+        raise ValueError("The maxsize argument must be a positive integer or None")
+    if ttl is not None and ttl <= 0:
+        raise ValueError("The ttl argument must be positive or None")
+    _check_sink(sink)
+    _check_key(key)
+
+    def decorator(fn):
+        if not callable(fn):
+            raise TypeError("The passed argument is not a function")
+        if isinstance(fn, type):
+            raise TypeError("The passed argument is a class type. Please use this decorator only for functions")
+        name = _counter_key(fn, key)
+        hits_key, misses_key = f"{name}.hits", f"{name}.misses"
+        cache = OrderedDict()
+        lock = threading.Lock()
+        is_coroutine = inspect.iscoroutinefunction(fn)
+        report = _nonblocking_report(sink) if is_coroutine else sink
+
+        def lookup(cache_key):
+            """
+            Returns the cached result for `cache_key`, or `_CACHE_MISS` on a miss, and counts and reports
+            the lookup.
+            """
+            with lock:
+                entry = cache.get(cache_key)
+                if entry is not None and (ttl is None or entry[1] > time.monotonic()):
+                    cache.move_to_end(cache_key)
+                    result = entry[0]
+                    hits = counter_dict[hits_key] = counter_dict.get(hits_key, 0) + 1
+                    misses = counter_dict.get(misses_key, 0)
+                else:
+                    if entry is not None:
+                        del cache[cache_key]
+                    result = _CACHE_MISS
+                    hits = counter_dict.get(hits_key, 0)
+                    misses = counter_dict[misses_key] = counter_dict.get(misses_key, 0) + 1
+            emit = report if report is not None else _default_sink
+            if emit is not silent_sink:
+                emit('{0} has been called {1} times, {2} from the cache'.format(name, hits + misses, hits))
+            return result
+
+        def store(cache_key, result):
+            expires = time.monotonic() + ttl if ttl is not None else None
+            with lock:
+                cache[cache_key] = (result, expires)
+                cache.move_to_end(cache_key)
+                if maxsize is not None and len(cache) > maxsize:
+                    cache.popitem(last=False)
+
+        if is_coroutine:
+            @wraps(fn)
+            async def inner(*args, **kwargs):
+                cache_key = _memo_key(args, kwargs)
+                result = lookup(cache_key)
+                if result is _CACHE_MISS:
+                    result = await fn(*args, **kwargs)
+                    store(cache_key, result)
+                return result
+        else:
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                cache_key = _memo_key(args, kwargs)
+                result = lookup(cache_key)
+                if result is _CACHE_MISS:
+                    result = fn(*args, **kwargs)
+                    store(cache_key, result)
+                return result
+
+        def cache_info():
+            """
+            Returns the hit and miss counts, the number of cached results and the maximum size of the cache.
+            """
+            with lock:
+                return {"hits": counter_dict.get(hits_key, 0), "misses": counter_dict.get(misses_key, 0),
+                        "size": len(cache), "maxsize": maxsize}
+
+        def cache_clear():
+            """
+            Drops every cached result.
+            """
+            with lock:
+                cache.clear()
+
+        def reset_counter():
+            """
+            This resets the hit and miss counters of the function to zero.
+            """
+            with lock:
+                counter_dict[hits_key] = counter_dict[misses_key] = 0
+
+        inner.cache_info = cache_info
+        inner.cache_clear = cache_clear
+        inner.reset_counter = reset_counter
+
+        return inner
+
+    return decorator
+
+class RateLimitExceeded(RuntimeError):
+    """
+    Raised by a function decorated with `rate_limit` when a call is rejected.
+    """
+
+class _TokenBucket:
+    """
+    A token bucket of `burst` tokens, refilled at `rate` tokens per second.
+
+    The tokens are items of a deque, so taking one while the bucket is not empty is a single atomic
+    `deque.pop()`, without any lock. Only an empty bucket takes the lock, to add the tokens earned since
+    the last refill.
+    """
+    __slots__ = ("rate", "burst", "_tokens", "_lock", "_last")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = deque([None] * burst, maxlen=burst)
+        self._lock = threading.Lock()
+        self._last = time.monotonic()
+
+    def take(self):
+        """
+        Takes a token and returns True, or returns False if the bucket is empty.
+        """
+        try:
+            self._tokens.pop()
+            return True
+        except IndexError:
+            pass
+        with self._lock:
+            now = time.monotonic()
+            earned = int((now - self._last) * self.rate)
+            if earned:
+                tokens = self._tokens
+                missing = self.burst - len(tokens)
+                tokens.extend([None] * min(earned, missing))
+                self._last = now if earned >= missing else self._last + earned / self.rate
+            try:
+                self._tokens.pop()
+                return True
+            except IndexError:
+                return False
+
+def rate_limit(counter_dict, *, rate=None, burst=None, max_concurrent=None, sink=None, key="name"):
+    """
+    A decorator factory that limits the calls per second and the concurrent calls of a function.
+
+    The calls per second are limited by a token bucket holding up to `burst` tokens and refilled at `rate`
+    tokens per second, and the calls in progress by a pool of `max_concurrent` permits. A call that finds no
+    token or no permit is rejected with `RateLimitExceeded` instead of waiting, so that an overloaded function
+    sheds load. Under the limits, a call takes a token and a permit with an atomic `deque.pop()` each, and
+    never takes a lock.
+
+    The admitted and rejected calls are counted in `counter_dict` under the keys "<name>.admitted" and
+    "<name>.rejected", and each call is reported to the sink.
+
+    If `fn` is a coroutine function, the returned function is one too, and its permit is held until the
+    coroutine completes.
+
+    Args:
+        counter_dict (dict): The dictionary to be updated with the admitted and rejected counts.
+        rate (float): The sustained number of calls per second, or None for no limit.
+        burst (int): The number of calls that can be made at once after an idle period. Defaults to `rate`,
+            rounded up.
+        max_concurrent (int): The number of calls that can be in progress at once, or None for no limit.
+        sink (callable): Where each call is reported. Defaults to the sink set with `set_default_sink`.
+        key (str): How the function is keyed in `counter_dict`: "name" or "qualname".
+
+    Raises:
+        TypeError: If the passed argument is not a function or if it is a class type.
+        ValueError: If `rate`, `burst` or `max_concurrent` is not positive, or `key` is unknown.
+
+    Returns:
+        function: A decorator that wraps the original function with the limits. Calls of the returned function
+        raise `RateLimitExceeded` when rejected.
+
+    Example:
+        limits = {}
+        @rate_limit(limits, rate=100, max_concurrent=8, sink=silent_sink)
+        def handler(request):
+            ...
+
+        try:
+            handler(request)
+        except RateLimitExceeded:
+            ...  # Respond with 429 Too Many Requests
+        print(limits)  # Output: {'handler.admitted': 1}
+    """
+    if not isinstance(counter_dict, dict):
+        raise TypeError("The counter_dict argument must be a dictionary")
+    if rate is not None and rate <= 0:
+        raise ValueError("The rate argument must be positive or None")
+    if burst is not None and (rate is None or not isinstance(burst, int) or burst < 1):
+        raise ValueError("The burst argument must be a positive integer, given with a rate")
+    if max_concurrent is not None and (not isinstance(max_concurrent, int) or max_concurrent < 1):
+        raise ValueError("The max_concurrent argument must be a positive integer or None")
+    _check_sink(sink)
+    _check_key(key)
+
+    def decorator(fn):
+        if not callable(fn):
+            raise TypeError("The passed argument is not a function")
+        if isinstance(fn, type):
+            raise TypeError("The passed argument is a class type. Please use this decorator only for functions")
+        name = _counter_key(fn, key)
+        admitted_key, rejected_key = f"{name}.admitted", f"{name}.rejected"
+        bucket = None if rate is None else _TokenBucket(rate, burst if burst is not None else math.ceil(rate))
+        permits = None if max_concurrent is None else deque([None] * max_concurrent)
+        is_coroutine = inspect.iscoroutinefunction(fn)
+        report = _nonblocking_report(sink) if is_coroutine else sink
+
+        def admit():
+            """
+            Takes a token and a permit, counts and reports the call, and raises `RateLimitExceeded` if either
+            is missing.
+            """
+            reason = None
+            if permits is not None:
+                try:
+                    permits.pop()
+                except IndexError:
+                    reason = f"{max_concurrent} concurrent calls"
+            if reason is None and bucket is not None and not bucket.take():
+                if permits is not None:
+                    permits.append(None)
+                reason = f"{rate} calls per second"
+            emit = report if report is not None else _default_sink
+            if reason is None:
+                cnt = counter_dict[admitted_key] = counter_dict.get(admitted_key, 0) + 1
+                if emit is not silent_sink:
+                    emit('{0} has been called {1} times'.format(name, cnt))
+                return
+            cnt = counter_dict[rejected_key] = counter_dict.get(rejected_key, 0) + 1
+            message = f"{name} exceeded its limit of {reason} and was rejected"
+            if emit is not silent_sink:
+                emit('{0} ({1} rejected calls)'.format(message, cnt))
+            raise RateLimitExceeded(message)
+
+        if is_coroutine:
+            @wraps(fn)
+            async def inner(*args, **kwargs):
+                admit()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    if permits is not None:
+                        permits.append(None)
+        elif permits is None:
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                admit()
+                return fn(*args, **kwargs)
+        else:
+            @wraps(fn)
+            def inner(*args, **kwargs):
+                admit()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    permits.append(None)
+
+        def reset_counter():
+            """
+            This resets the admitted and rejected counters of the function to zero.
+            """
+            counter_dict[admitted_key] = counter_dict[rejected_key] = 0
         inner.reset_counter = reset_counter
 
         return inner
 
     return decorator
+
+def snapshot_counters(source=None):
+    """
+    Returns a point-in-time copy of call counts, taken in one operation.
+
+    For a counter dictionary this is a single `dict.copy()`, which runs without releasing the GIL, so the
+    copy is consistent even while decorated functions keep updating the live dictionary. Callers then
+    iterate the copy instead of the live dictionary.
+
+    Args:
+        source (dict or counter backend): A counter dictionary, or a backend such as `ShardedCounter` or
+            `SharedMemoryCounter`. Defaults to the global `func_count`.
+
+    Returns:
+        dict: The count of every function, keyed by function name.
+    """
+    if source is None:
+        source = func_count
+    if isinstance(source, dict):
+        return source.copy()
+    return source.snapshot()
+
+def reset_all_counters(counter_dict=None):
+    """
+    Zeroes every count of a counter dictionary in one operation.
+
+    Args:
+        counter_dict (dict): The counter dictionary. Defaults to the global `func_count`.
+
+    Raises:
+        TypeError: If `counter_dict` is not a dictionary.
+    """
+    if counter_dict is None:
+        counter_dict = func_count
+    if not isinstance(counter_dict, dict):
+        raise TypeError("The counter_dict argument must be a dictionary")
+    counter_dict.update(dict.fromkeys(counter_dict, 0))
+
+class CounterScraper:
+    """
+    Reports the calls made since the previous scrape, for metrics scrapers that poll the counters.
+
+    Each `scrape()` takes one snapshot with `snapshot_counters` and subtracts the previous one. A count
+    lower than at the previous scrape means the counter was reset, and the new count is reported in full.
+
+    Args:
+        source (dict or counter backend): What to scrape. Defaults to the global `func_count`.
+
+    Example:
+        scraper = CounterScraper(dict1)
+        add(1, 2)
+        print(scraper.scrape())  # Output: {'add': 1}
+        print(scraper.scrape())  # Output: {'add': 0}
+    """
+
+    def __init__(self, source=None):
+        self.source = source
+        self._last = {}
+
+    def scrape(self):
+        """
+        Returns the number of calls of every function since the previous scrape.
+        """
+        current = snapshot_counters(self.source)
+        last = self._last
+        delta = {}
+        for name, count in current.items():
+            previous = last.get(name, 0)
+            delta[name] = count - previous if count >= previous else count
+        self._last = current
+        return delta
+
+def _prometheus_label(value):
+    """
+    Escapes a Prometheus label value.
+    """
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def export_prometheus(counts, metric="function_calls_total"):
+    """
+    Formats call counts in the Prometheus text exposition format, as one counter labelled by function.
+
+    Example:
+        print(export_prometheus({'add': 2}))
+        # Output:
+        # # HELP function_calls_total Number of calls of each decorated function.
+        # # TYPE function_calls_total counter
+        # function_calls_total{function="add"} 2
+    """
+    lines = [
+        f"# HELP {metric} Number of calls of each decorated function.",
+        f"# TYPE {metric} counter",
+    ]
+    lines += [f'{metric}{{function="{_prometheus_label(name)}"}} {count}' for name, count in counts.items()]
+    return "\n".join(lines) + "\n"
+
+def export_json_lines(counts, timestamp=None):
+    """
+    Formats call counts as JSON lines, one object per function, e.g. `{"function": "add", "calls": 2}`.
+
+    Args:
+        counts (dict): The counts, for instance from `snapshot_counters` or `CounterScraper.scrape`.
+        timestamp (float): If given, added to every line as "timestamp".
+    """
+    import json
+
+    if timestamp is None:
+        return "".join(json.dumps({"function": name, "calls": count}) + "\n" for name, count in counts.items())
+    return "".join(
+        json.dumps({"function": name, "calls": count, "timestamp": timestamp}) + "\n" for name, count in counts.items()
+    )
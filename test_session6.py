@@ -4,10 +4,35 @@ import session6
 import os
 import inspect
 import re
-from session6 import checker
-from session6 import fibonacci_closure
-from session6 import function_counter_with_one_dict,func_count
-from session6 import function_counter_multi_dict
+import io
+import logging
+import sys
+import threading
+import time
+import timeit
+import json
+import asyncio
+import weakref
+import gc
+import textwrap
+import importlib
+import pickle
+import subprocess
+import tracemalloc
+from functools import wraps
+from array import array
+from itertools import islice
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from session6 import checker, audit_docstrings, enforce_docstrings, decorate_module
+from session6 import fibonacci_closure, fibonacci, FibonacciStream, FibonacciCache, fibonacci_mod_array, fibonacci_range
+from session6 import function_counter_with_one_dict,func_count,func_latency
+from session6 import function_counter_multi_dict, CountedFunction, instrument, memoize, rate_limit, RateLimitExceeded
+from session6 import disable_instrumentation, enable_instrumentation
+from session6 import ShardedCounter, SharedMemoryCounter, MappedFileCounter, LatencyHistogram, ShapeTable, func_shapes
+from session6 import snapshot_counters, reset_all_counters, CounterScraper, export_prometheus, export_json_lines
+from session6 import print_sink, silent_sink, LoggingSink, QueueSink, set_default_sink, get_default_sink
 
 README_CONTENT_CHECK_FOR = [
     'checker',
@@ -149,6 +174,146 @@ def closure_function_run_test():
 
     assert add(10, 20) == 30
 
+def per_call_seconds(fn, calls=20000, repeat=5):
+    """
+    Returns the best-of-`repeat` time in seconds of a single call to `fn`.
+    """
+    return min(timeit.repeat(fn, number=calls, repeat=repeat)) / calls
+
+# Benchmarks with a hard wall-clock threshold fail at random on a loaded machine, so they only run when
+# SESSION6_TIMING_TESTS is set. benchmark_session6.py tracks the same costs against a saved baseline.
+timing = pytest.mark.skipif(not os.environ.get("SESSION6_TIMING_TESTS"),
+                            reason="wall-clock benchmark, set SESSION6_TIMING_TESTS=1 to run it")
+
+def test_closure_eager_validation():
+    '''
+    Test 8: In eager mode a short docstring must raise at decoration time, not at call time.
+    '''
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        def short_docstring_function():
+            """Short doc"""
+            return "Short docstring"
+        checker(short_docstring_function, eager=True)
+
+def test_closure_revalidates_mutated_docstring():
+    '''
+    Test 9: The cached docstring verdict must be recomputed when `__doc__` is reassigned.
+    '''
+    def add(a, b):
+        """
+        This function adds two numbers of any type and returns the sum.
+        """
+        return a + b
+
+    lazy = checker(add)
+    eager = checker(add, eager=True)
+    assert lazy(1, 2) == 3 and eager(1, 2) == 3
+
+    add.__doc__ = "Short doc"
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        lazy(1, 2)
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        eager(1, 2)
+
+@timing
+def test_closure_eager_overhead(capsys):
+    '''
+    Test 10: Micro-benchmark, an eagerly validated function must add well under a microsecond per call.
+    '''
+    def add():
+        """
+        This function adds two numbers of any type and returns the sum.
+        """
+        return 1 + 2
+
+    passthrough = checker(add, eager=True, revalidate=False)
+    validated = checker(add, eager=True)
+    per_call_check = checker(add)
+
+    base = per_call_seconds(add)
+    passthrough_overhead = per_call_seconds(passthrough) - base
+    validated_overhead = per_call_seconds(validated) - base
+    per_call_check_overhead = per_call_seconds(per_call_check, calls=2000) - base
+    capsys.readouterr()
+
+    print(f"checker overhead per call: passthrough {passthrough_overhead * 1e9:.0f}ns, "
+          f"validated {validated_overhead * 1e9:.0f}ns, per-call check {per_call_check_overhead * 1e9:.0f}ns")
+    assert passthrough_overhead < 1e-6 and validated_overhead < 1e-6
+    assert validated_overhead < per_call_check_overhead
+
+LONG_DOCSTRING = "This function has a docstring that is comfortably longer than fifty characters."
+
+def write_audit_package(root):
+    """Writes a package with passing and failing docstrings to `root` and returns its name."""
+    for module_name in [m for m in sys.modules if m.split(".")[0] == "auditpkg"]:
+        del sys.modules[module_name]
+    importlib.invalidate_caches()
+    package = root / "auditpkg"
+    (package / "sub").mkdir(parents=True)
+    (package / "__init__.py").write_text(textwrap.dedent(f'''
+        from session6 import checker, function_counter_multi_dict
+
+        def good():
+            """{LONG_DOCSTRING}"""
+
+        def missing():
+            pass
+
+        @checker
+        def checked():
+            pass
+
+        class Service:
+            @function_counter_multi_dict({{}})
+            def counted(self):
+                """Short doc"""
+    '''))
+    (package / "sub" / "__init__.py").write_text("")
+    (package / "sub" / "helpers.py").write_text(textwrap.dedent(f'''
+        from auditpkg import good
+
+        class Tool:
+            def method(self):
+                """Short doc"""
+
+            @staticmethod
+            def helper():
+                """{LONG_DOCSTRING}"""
+    '''))
+    return "auditpkg"
+
+def test_audit_docstrings_package(tmp_path, monkeypatch):
+    '''
+    Test 11: The audit must report every failing function of every submodule at once, in-process and
+    in a process pool, without reporting functions merely imported into a module. Functions already
+    decorated with `checker` or a counter must be audited too.
+    '''
+    monkeypatch.syspath_prepend(str(tmp_path))
+    name = write_audit_package(tmp_path)
+    expected = {
+        'auditpkg.missing': 'The passed function has no docstring.',
+        'auditpkg.checked': 'The passed function has no docstring.',
+        'auditpkg.Service.counted': "Function 'counted' requires a docstring longer than 50 characters.",
+        'auditpkg.sub.helpers.Tool.method': "Function 'method' requires a docstring longer than 50 characters.",
+    }
+    assert audit_docstrings(name) == expected
+    assert audit_docstrings(importlib.import_module(name), processes=2) == expected
+
+    with pytest.raises(ValueError, match=r"4 function\(s\) failed the docstring check"):
+        enforce_docstrings(name)
+    with pytest.raises(TypeError, match=r"The passed argument is not a module"):
+        audit_docstrings(42)
+
+def test_decorate_module(tmp_path, monkeypatch):
+    '''
+    Test 12: decorate_module must wrap every function defined in the module, and only those.
+    '''
+    monkeypatch.syspath_prepend(str(tmp_path))
+    module = importlib.import_module(write_audit_package(tmp_path) + ".sub.helpers")
+    package = importlib.import_module("auditpkg")
+    assert decorate_module(package, lambda fn: checker(fn, eager=True, sink=silent_sink), lambda fn: fn.__doc__) == ['good']
+    assert decorate_module(module, checker) == []
+
 ######################## Validations for Next Fibbonacci Number Closure#################################
 
 def test_fibonacci_no_arguments():
@@ -177,6 +342,208 @@ def test_fibonacci_series_generated():
     assert x==[0, 1, 1, 2, 3, 5, 8, 13, 21, 34], 'Fibbonacci series is not working as expected'
 
 
+def test_fibonacci_direct_index():
+    '''
+    fibonacci(n) must agree with the closure, and reject indices that are not non-negative integers.
+    '''
+    next_fibonacci = fibonacci_closure()
+    assert [fibonacci(n) for n in range(200)] == [next_fibonacci() for _ in range(200)]
+
+    with pytest.raises(TypeError, match=r"The n argument must be an integer"):
+        fibonacci(1.5)
+    with pytest.raises(ValueError, match=r"The n argument must not be negative"):
+        fibonacci(-1)
+
+def test_fibonacci_take_skip_seek():
+    '''
+    take, skip and seek must move the closure to the same state as the equivalent number of calls.
+    '''
+    next_fibonacci = fibonacci_closure()
+    assert next_fibonacci.take(10) == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+    assert next_fibonacci() == 55
+
+    next_fibonacci.skip(0)
+    assert next_fibonacci() == 89
+    next_fibonacci.skip(1000)
+    assert next_fibonacci.take(2) == [fibonacci(1012), fibonacci(1013)]
+
+    next_fibonacci.seek(0)
+    assert next_fibonacci.take(0) == [] and next_fibonacci() == 0
+    next_fibonacci.seek(500)
+    assert next_fibonacci() == fibonacci(500)
+
+    with pytest.raises(ValueError, match=r"The k argument must not be negative"):
+        next_fibonacci.skip(-1)
+
+def test_fibonacci_fast_doubling_benchmark():
+    '''
+    Benchmark: jumping straight to F(n) must beat stepping the closure n times.
+    '''
+    for n in (10 ** 3, 10 ** 4, 10 ** 5):
+        start = time.perf_counter()
+        next_fibonacci = fibonacci_closure()
+        for _ in range(n):
+            next_fibonacci()
+        stepped = next_fibonacci()
+        step_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        direct = fibonacci(n)
+        direct_time = time.perf_counter() - start
+
+        print(f"F({n}): closure {step_time * 1e3:.2f}ms, fast doubling {direct_time * 1e3:.3f}ms")
+        assert stepped == direct
+        assert direct_time < step_time
+
+def test_fibonacci_stream_islice_and_resume():
+    '''
+    The stream must work with islice and resume from a saved or pickled state where it stopped.
+    '''
+    stream = FibonacciStream()
+    assert list(islice(stream, 10)) == [0, 1, 1, 2, 3, 5, 8, 13, 21, 34]
+
+    saved = stream.state()
+    assert saved == (10, 55, 89)
+    assert list(islice(FibonacciStream.from_state(saved), 3)) == [55, 89, 144]
+    assert list(islice(pickle.loads(pickle.dumps(stream)), 3)) == [55, 89, 144]
+    assert next(FibonacciStream(300)) == fibonacci(300)
+
+    with pytest.raises(ValueError, match=r"The index argument must not be negative"):
+        FibonacciStream(-1)
+
+def test_fibonacci_stream_chunks():
+    '''
+    Chunks must be lists or arrays of consecutive terms, and a chunk that overflows its array
+    typecode must not advance the stream.
+    '''
+    stream = FibonacciStream()
+    chunks = stream.chunks(4)
+    assert next(chunks) == [0, 1, 1, 2] and next(chunks) == [3, 5, 8, 13]
+    assert stream.index == 8
+
+    arrays = FibonacciStream(88).chunks(3, typecode="Q")
+    assert next(arrays) == array("Q", [fibonacci(88), fibonacci(89), fibonacci(90)])
+    assert next(arrays) == array("Q", [fibonacci(91), fibonacci(92), fibonacci(93)])
+    stream = FibonacciStream(92)
+    with pytest.raises(OverflowError):
+        next(stream.chunks(3, typecode="Q"))
+    assert stream.index == 92
+
+    assert list(islice(FibonacciStream().terms(chunk_size=3), 7)) == [0, 1, 1, 2, 3, 5, 8]
+    with pytest.raises(ValueError, match=r"The size argument must be at least 1"):
+        next(FibonacciStream().chunks(0))
+
+def test_fibonacci_stream_benchmark():
+    '''
+    Benchmark: streaming terms in chunks must cost less per term than calling the closure. The first
+    1000 terms are used, so that per-term overhead rather than big-integer addition dominates.
+    '''
+    n = 1000
+
+    def consume_closure():
+        next_fibonacci = fibonacci_closure()
+        return [next_fibonacci() for _ in range(n)]
+
+    def consume_stream():
+        return list(islice(FibonacciStream().terms(), n))
+
+    closure_time = per_call_seconds(consume_closure, calls=20, repeat=5)
+    stream_time = per_call_seconds(consume_stream, calls=20, repeat=5)
+
+    print(f"{n} terms: closure {closure_time * 1e6:.0f}us, chunked stream {stream_time * 1e6:.0f}us")
+    assert consume_stream() == consume_closure()
+    assert stream_time < closure_time
+
+def test_fibonacci_cache_lookups_and_stats():
+    '''
+    Repeated lookups must hit the cache, nearby lookups must reuse a checkpoint, and both the
+    cache and the checkpoints must stay within their bounds.
+    '''
+    cache = FibonacciCache(maxsize=2, checkpoint_interval=100, max_checkpoints=2)
+    assert cache[500] == fibonacci(500)
+    assert cache[20] == fibonacci(20)
+    assert cache[500] == fibonacci(500)
+    assert cache[550] == fibonacci(550)
+    assert cache[1000] == fibonacci(1000)
+    assert cache[120] == fibonacci(120)
+
+    assert cache.stats() == {
+        'hits': 1, 'misses': 5, 'evictions': 3, 'size': 2,
+        'checkpoint_hits': 1, 'checkpoint_misses': 4, 'checkpoint_evictions': 2, 'checkpoints': 2,
+    }
+    cache.clear()
+    assert cache.stats()['misses'] == 0 and cache.stats()['size'] == 0
+
+    with pytest.raises(ValueError, match=r"The n argument must not be negative"):
+        cache[-1]
+    with pytest.raises(ValueError, match=r"must be at least 1"):
+        FibonacciCache(maxsize=0)
+
+def test_fibonacci_modular_closure():
+    '''
+    The modular closure, including take, skip and seek, must match the plain sequence mod m.
+    '''
+    modulus = 1000
+    next_fibonacci = fibonacci_closure()
+    next_modular = fibonacci_closure(modulus)
+    assert [next_modular() for _ in range(300)] == [next_fibonacci() % modulus for _ in range(300)]
+
+    assert next_modular.take(3) == [fibonacci(n) % modulus for n in range(300, 303)]
+    next_modular.skip(10 ** 6)
+    assert next_modular() == fibonacci(10 ** 6 + 303) % modulus
+    next_modular.seek(10 ** 9)
+    assert next_modular() == fibonacci(10 ** 9, modulus=modulus)
+    assert fibonacci(12345, modulus=97) == fibonacci(12345) % 97
+    assert fibonacci_closure(1)() == 0
+
+    with pytest.raises(ValueError, match="No arguments should be passed to this function."):
+        next_modular(1)
+    with pytest.raises(ValueError, match=r"The modulus argument must be at least 1"):
+        fibonacci_closure(0)
+    with pytest.raises(TypeError, match=r"The modulus argument must be an integer"):
+        fibonacci(10, modulus=2.5)
+
+def test_fibonacci_mod_array():
+    '''
+    The vectorized evaluation must match fibonacci(n, modulus) for every index and keep the shape.
+    '''
+    numpy = pytest.importorskip("numpy")
+    indices = numpy.array([[0, 1, 2, 3], [100, 1000, 10 ** 6, 2 ** 40]])
+    for modulus in (1, 5, 10 ** 9 + 7, 2 ** 32 - 1):
+        result = fibonacci_mod_array(indices, modulus)
+        assert result.shape == indices.shape
+        assert result.tolist() == [[fibonacci(int(i), modulus=modulus) for i in row] for row in indices]
+
+    with pytest.raises(ValueError, match=r"The modulus argument must be below 2 \*\* 32"):
+        fibonacci_mod_array(indices, 2 ** 32)
+    with pytest.raises(ValueError, match=r"must not contain negative indices"):
+        fibonacci_mod_array(numpy.array([-1]), 5)
+    with pytest.raises(TypeError, match=r"must be an array of integers"):
+        fibonacci_mod_array(numpy.array([1.5]), 5)
+
+def test_fibonacci_mod_array_benchmark():
+    '''
+    Benchmark: evaluating 2000 indices mod m in one vectorized call must beat stepping the modular
+    closure up to the largest index.
+    '''
+    numpy = pytest.importorskip("numpy")
+    modulus = 10 ** 9 + 7
+    indices = numpy.random.default_rng(0).integers(0, 50000, 2000)
+
+    start = time.perf_counter()
+    vectorized = fibonacci_mod_array(indices, modulus)
+    vectorized_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    next_modular = fibonacci_closure(modulus)
+    terms = [next_modular() for _ in range(int(indices.max()) + 1)]
+    looped = [terms[i] for i in indices]
+    loop_time = time.perf_counter() - start
+
+    print(f"{indices.size} indices mod m: closure loop {loop_time * 1e3:.2f}ms, vectorized {vectorized_time * 1e3:.2f}ms")
+    assert vectorized.tolist() == looped
+    assert vectorized_time < loop_time
+
 ######################## Validations for function counter with one dictionary ####################
 @function_counter_with_one_dict
 def add_1(a: int, b: int = 10) -> int:
@@ -395,3 +762,1239 @@ def test_function_call_counts_after_reset_multi_dict():
     
     # Assert that the dictionary matches the expected dictionary respectively
     assert dict1 == expected1 and dict2==expected2 , f"Count is not updated to correct dictionaries after resetting counter"
+
+
+######################## Validations for reporting sinks ####################
+
+def test_sink_argument_type():
+    """A sink that is not callable must be rejected when decorating."""
+    with pytest.raises(TypeError, match=r"The sink argument must be callable"):
+        function_counter_multi_dict({}, sink="stdout")
+    with pytest.raises(TypeError, match=r"The sink argument must be callable"):
+        set_default_sink(None)
+
+def test_sink_per_decorator_and_global(capsys):
+    """
+    An explicit sink receives the report messages, and the global default applies to functions
+    decorated without one, including ones decorated before the default was changed.
+    """
+    messages = []
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=messages.append)
+    def add(a, b):
+        return a + b
+
+    @function_counter_multi_dict(counts)
+    def mul(a, b):
+        return a * b
+
+    add(1, 2)
+    previous = set_default_sink(silent_sink)
+    try:
+        mul(2, 3)
+        assert get_default_sink() is silent_sink
+    finally:
+        set_default_sink(previous)
+
+    assert messages == ['add has been called 1 times']
+    assert capsys.readouterr().out == ''
+    assert counts == {'add': 1, 'mul': 1}
+
+def test_logging_sink(caplog):
+    """LoggingSink must forward the report message to the logger at the configured level."""
+    @function_counter_multi_dict({}, sink=LoggingSink(level=logging.WARNING))
+    def add(a, b):
+        return a + b
+
+    with caplog.at_level(logging.WARNING, logger="session6"):
+        add(1, 2)
+    assert caplog.messages == ['add has been called 1 times']
+
+def test_queue_sink_delivers_in_order():
+    """QueueSink must write every message, in order, from its background thread."""
+    stream = io.StringIO()
+    sink = QueueSink(stream=stream, batch_size=7)
+
+    @function_counter_multi_dict({}, sink=sink)
+    def add(a, b):
+        return a + b
+
+    for _ in range(100):
+        add(1, 2)
+    sink.close()
+    assert stream.getvalue().splitlines() == [f'add has been called {i} times' for i in range(1, 101)]
+
+def test_sink_throughput(capsys):
+    """
+    Benchmark: calls/sec through a counter for each sink on a trivial function. Silent reporting
+    must outrun a synchronous print, which pytest captures here and is cheaper than a real terminal.
+    """
+    queue_sink = QueueSink(stream=io.StringIO())
+    sinks = {
+        'print': print_sink,
+        'logging': LoggingSink(logger=logging.getLogger("session6.benchmark"), level=logging.DEBUG),
+        'queue': queue_sink,
+        'silent': silent_sink,
+    }
+    rates = {}
+    for name, sink in sinks.items():
+        @function_counter_multi_dict({}, sink=sink)
+        def add(a, b):
+            return a + b
+        rates[name] = 1 / per_call_seconds(lambda: add(1, 2), calls=2000, repeat=3)
+    queue_sink.close()
+    capsys.readouterr()
+
+    print("calls/sec per sink: " + ", ".join(f"{name} {rate:,.0f}" for name, rate in rates.items()))
+    assert rates['silent'] > rates['print']
+
+
+######################## Validations for thread-safe counting ####################
+
+def test_sharded_counter_exact_under_threads():
+    """
+    Stress test: hammer one decorated function from many threads and check that no call is lost.
+    """
+    threads, calls = 16, 5000
+    counter = ShardedCounter()
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink, backend=counter)
+    def work(i):
+        return i
+
+    def hammer(_):
+        for i in range(calls):
+            work(i)
+
+    with ThreadPoolExecutor(threads) as pool:
+        list(pool.map(hammer, range(threads)))
+
+    assert counter.get('work') == threads * calls
+    assert counts == {}
+    assert counter.sync() == {'work': threads * calls} and counts == {'work': threads * calls}
+
+def test_sharded_counter_reset():
+    """reset_counter must zero the total across all shards while keeping later calls counted."""
+    counter = ShardedCounter()
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink, backend=counter)
+    def work():
+        """Does nothing."""
+
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: work(), range(100)))
+    work.reset_counter()
+    work()
+    counter.sync()
+    assert counts == {'work': 1}
+    assert work.__name__ == 'work' and work.__doc__ == 'Does nothing.'
+
+def test_sharded_counter_retires_exited_threads():
+    """The shards of exited threads must be folded into the totals instead of being kept for ever."""
+    counter = ShardedCounter()
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink, backend=counter)
+    def work():
+        """Does nothing."""
+
+    work()
+    for _ in range(3):
+        workers = [threading.Thread(target=lambda: [work() for _ in range(10)]) for _ in range(50)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        del workers
+        gc.collect()
+    assert len(counter._state[0]) == 1
+    assert counter.get('work') == 1501 and counter.snapshot() == {'work': 1501}
+    work.reset_counter()
+    worker = threading.Thread(target=work)
+    worker.start()
+    worker.join()
+    work()
+    assert counter.sync() == {'work': 2} and counts == {'work': 2}
+
+def test_sharded_counter_backend_type():
+    """A backend without the counter methods must be rejected."""
+    with pytest.raises(TypeError, match=r"The backend argument must provide"):
+        function_counter_multi_dict({}, backend={})
+
+
+######################## Validations for multiprocess counting ####################
+
+shared_counter = None
+shared_counts = {}
+
+def attach_shared_counter(counter):
+    """Pool initializer: decorates `shared_work` in the worker with the counter received from the parent."""
+    global shared_counter, shared_work
+    shared_counter = counter
+    shared_work = function_counter_multi_dict(shared_counts, sink=silent_sink, backend=counter)(square)
+
+def square(x):
+    return x * x
+
+def shared_work(x):
+    return square(x)
+
+def test_shared_memory_counter_across_forked_processes():
+    """Every forked process and thread must add its calls to the same table without losing any."""
+    processes, threads, calls = 4, 4, 2000
+
+    with SharedMemoryCounter(capacity=8, rows=32) as counter:
+        counts = {}
+
+        @function_counter_multi_dict(counts, sink=silent_sink, backend=counter)
+        def work():
+            """Does nothing."""
+
+        def hammer():
+            with ThreadPoolExecutor(threads) as pool:
+                list(pool.map(lambda _: [work() for _ in range(calls)], range(threads)))
+
+        work()
+        context = multiprocessing.get_context("fork")
+        children = [context.Process(target=hammer) for _ in range(processes)]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+
+        assert all(child.exitcode == 0 for child in children)
+        assert counter.get('work') == 1 + processes * threads * calls
+        assert counter.snapshot() == {'work': 1 + processes * threads * calls}
+        work.reset_counter()
+        counter.sync()
+        assert counts == {'work': 0}
+
+def test_shared_memory_counter_in_spawned_pool():
+    """The counter must be usable from spawned pool workers, which receive it pickled in `initargs`."""
+    context = multiprocessing.get_context("spawn")
+    with SharedMemoryCounter(capacity=8, rows=8, context=context) as counter:
+        with ProcessPoolExecutor(2, mp_context=context, initializer=attach_shared_counter, initargs=(counter,)) as pool:
+            assert list(pool.map(shared_work, range(100))) == [x * x for x in range(100)]
+        assert counter.snapshot() == {'square': 100}
+
+def test_shared_memory_counter_limits():
+    """Names that do not fit and a full name table must raise instead of corrupting the table."""
+    with SharedMemoryCounter(capacity=1, rows=1) as counter:
+        with pytest.raises(ValueError, match=r"is longer than 64 bytes"):
+            counter.increment('f' * 65)
+        counter.increment('f')
+        with pytest.raises(RuntimeError, match=r"slots of the counter table are in use"):
+            counter.increment('g')
+
+def test_shared_memory_counter_recycles_rows():
+    """Rows of exited threads and dead processes must be reused, and threads finding no row must share one."""
+    with SharedMemoryCounter(capacity=4, rows=2) as counter:
+        counts = {}
+        work = function_counter_multi_dict(counts, sink=silent_sink, backend=counter)(square)
+        for x in range(6):
+            thread = threading.Thread(target=work, args=(x,))
+            thread.start()
+            thread.join()
+        assert counter.get('square') == 6
+
+        release = threading.Event()
+        def hold(x):
+            work(x)
+            release.wait()
+        threads = [threading.Thread(target=hold, args=(x,)) for x in range(5)]
+        for thread in threads:
+            thread.start()
+        for x in range(2000):
+            work(x)
+        release.set()
+        for thread in threads:
+            thread.join()
+        assert counter.get('square') == 2011
+
+        context = multiprocessing.get_context("fork")
+        children = [context.Process(target=work, args=(x,)) for x in range(2)]
+        for child in children:
+            child.start()
+        for child in children:
+            child.join()
+        assert counter.get('square') == 2013
+        with ThreadPoolExecutor(2) as pool:
+            list(pool.map(work, range(100)))
+        assert counter.get('square') == 2113
+        assert counter.snapshot() == {'square': 2113}
+
+
+
+######################## Validations for persistent counting ####################
+
+def count_and_crash(path, calls):
+    """Counts `calls` calls into the file, then exits without closing or flushing it."""
+    counter = MappedFileCounter(path, flush_interval=None)
+    work = function_counter_multi_dict({}, sink=silent_sink, backend=counter)(square)
+    for x in range(calls):
+        work(x)
+    os._exit(0)
+
+def read_snapshot(path, queue):
+    with MappedFileCounter(path, readonly=True) as counter:
+        queue.put(counter.snapshot())
+
+def test_mapped_file_counter_resumes_after_crash(tmp_path):
+    """Counts written by a process that dies without closing the file must be resumed by the next one."""
+    path = tmp_path / "counts.bin"
+    context = multiprocessing.get_context("fork")
+    for _ in range(2):
+        child = context.Process(target=count_and_crash, args=(path, 1000))
+        child.start()
+        child.join()
+
+    with MappedFileCounter(path, capacity=4, rows=2) as counter:
+        assert counter.capacity == 1024 and counter.rows == 64
+        counts = {}
+        work = function_counter_multi_dict(counts, sink=silent_sink, backend=counter)(square)
+        work(3)
+        counter.sync()
+        assert counts == {'square': 2001}
+        work.reset_counter()
+    with MappedFileCounter(path) as counter:
+        assert counter.snapshot() == {'square': 0}
+
+def test_mapped_file_counter_readers(tmp_path):
+    """Another process must read the live counts, and only one process may open the file for writing."""
+    path = tmp_path / "counts.bin"
+    with MappedFileCounter(path, capacity=8, rows=4) as counter:
+        work = function_counter_with_one_dict(square, sink=silent_sink, backend=counter)
+        for x in range(10):
+            work(x)
+        assert counter.get('square') == 10
+
+        context = multiprocessing.get_context("spawn")
+        queue = context.Queue()
+        reader = context.Process(target=read_snapshot, args=(path, queue))
+        reader.start()
+        assert queue.get(timeout=30) == {'square': 10}
+        reader.join()
+        with MappedFileCounter(path, readonly=True) as reader:
+            assert reader.get('square') == 10 and reader.get('unknown') == 0
+        assert counter.get('unknown') == 0 and counter.snapshot() == {'square': 10}
+
+        with pytest.raises(RuntimeError, match=r"is open for writing in another process"):
+            MappedFileCounter(path)
+
+    (tmp_path / "junk.bin").write_bytes(b"x" * 4096)
+    (tmp_path / "empty.bin").touch()
+    with pytest.raises(ValueError, match=r"does not hold a counter table"):
+        MappedFileCounter(tmp_path / "junk.bin")
+    with pytest.raises(ValueError, match=r"does not hold a counter table"):
+        MappedFileCounter(tmp_path / "empty.bin", readonly=True)
+
+######################## Validations for latency histograms ####################
+
+def test_latency_histogram_quantiles():
+    """Quantiles must land in the bucket of the true value, within the 6.25% bucket width."""
+    histogram = LatencyHistogram()
+    for ns in range(1, 10001):
+        histogram.record(ns)
+
+    assert histogram.count == 10000 and histogram.mean() == 5000.5
+    for q, expected in ((0.5, 5000), (0.95, 9500), (0.99, 9900)):
+        assert abs(histogram.quantile(q) - expected) <= expected * 0.0625
+    assert histogram.percentiles() == {'p50': histogram.quantile(0.5), 'p95': histogram.quantile(0.95),
+                                       'p99': histogram.quantile(0.99)}
+    with pytest.raises(ValueError, match=r"The quantile must be between 0 and 1"):
+        histogram.quantile(1.5)
+
+    histogram.reset()
+    assert histogram.count == 0 and histogram.quantile(0.5) == 0
+
+def test_latency_timing_mode():
+    """
+    Timed counters must record one latency per call, including calls that raise, without
+    disturbing the call counts.
+    """
+    counts, latencies = {}, {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink, latency_dict=latencies)
+    def nap(seconds):
+        if seconds < 0:
+            raise ValueError("negative")
+        time.sleep(seconds)
+
+    nap(0.002)
+    nap(0.002)
+    with pytest.raises(ValueError):
+        nap(-1)
+
+    assert counts == {'nap': 3}
+    assert latencies == {'nap': nap.latency} and nap.latency.count == 3
+    assert nap.latency.quantile(0.99) >= 2_000_000 * 0.9375
+
+    def timed():
+        """Returns one."""
+        return 1
+    timed = function_counter_with_one_dict(timed, sink=silent_sink, timing=True)
+    timed()
+    assert func_latency['timed'] is timed.latency and timed.latency.count == 1
+    del func_count['timed'], func_latency['timed']
+    assert add_1.latency is None and 'add_1' not in func_latency
+
+
+######################## Validations for wrapper metadata ####################
+
+def test_counter_metadata_applied_at_decoration():
+    """
+    Name, qualified name, docstring, signature and __wrapped__ must be right before the first call,
+    for every counter variant.
+    """
+    def add(a: int, b: int = 10) -> int:
+        """
+        This function adds two numbers of any type and returns the sum.
+        """
+        return a + b
+
+    wrappers = [
+        function_counter_with_one_dict(add, sink=silent_sink),
+        function_counter_multi_dict({}, sink=silent_sink)(add),
+        function_counter_multi_dict({}, sink=silent_sink, backend=ShardedCounter())(add),
+    ]
+    for wrapper in wrappers:
+        assert wrapper.__name__ == 'add' and wrapper.__qualname__ == add.__qualname__
+        assert wrapper.__doc__ == add.__doc__ and wrapper.__wrapped__ is add
+        assert inspect.signature(wrapper) == inspect.signature(add)
+    assert 'add' not in func_count
+
+@timing
+def test_counter_overhead():
+    """
+    Benchmark: with reporting silenced, a counted call must add well under a microsecond over the
+    undecorated function.
+    """
+    def add(a, b):
+        return a + b
+
+    counted = function_counter_multi_dict({}, sink=silent_sink)(add)
+    base = per_call_seconds(lambda: add(1, 2))
+    overhead = per_call_seconds(lambda: counted(1, 2)) - base
+
+    print(f"counter overhead per call: {overhead * 1e9:.0f}ns")
+    assert overhead < 1e-6
+
+
+######################## Validations for coroutine functions ####################
+
+def test_async_counter_counts_on_completion():
+    """
+    Counters of coroutine functions must stay coroutine functions, and count, time and report a call
+    only once its coroutine has completed, including when it raises.
+    """
+    counts, latencies, messages = {}, {}, []
+    counter = ShardedCounter()
+
+    async def fetch(delay):
+        """Sleeps for `delay` seconds, or fails if it is negative."""
+        if delay < 0:
+            raise ValueError("negative")
+        await asyncio.sleep(delay)
+        return delay
+
+    plain = function_counter_multi_dict(counts, sink=messages.append, latency_dict=latencies)(fetch)
+    sharded = function_counter_multi_dict({}, sink=silent_sink, backend=counter)(fetch)
+
+    async def main():
+        coroutine = plain(0.01)
+        assert counts == {}
+        assert await coroutine == 0.01
+        assert counts == {'fetch': 1}
+        with pytest.raises(ValueError):
+            await plain(-1)
+        await asyncio.gather(*(sharded(0) for _ in range(50)))
+
+    asyncio.run(main())
+    assert inspect.iscoroutinefunction(plain) and inspect.iscoroutinefunction(sharded)
+    assert counts == {'fetch': 2} and counter.get('fetch') == 50
+    assert latencies['fetch'].count == 2 and latencies['fetch'].quantile(0.99) >= 9_000_000
+
+    session6._nonblocking(messages.append).flush()
+    assert messages == ['fetch has been called 1 times', 'fetch has been called 2 times']
+
+def test_async_one_dict_and_checker(capsys):
+    """
+    checker and function_counter_with_one_dict must accept coroutine functions, and report without
+    printing from the event loop thread.
+    """
+    async def ping():
+        """
+        This coroutine answers a ping with a pong after yielding to the event loop once.
+        """
+        await asyncio.sleep(0)
+        return "pong"
+
+    async def short():
+        """Short doc"""
+
+    counted = function_counter_with_one_dict(ping)
+    checked = checker(ping)
+    assert inspect.iscoroutinefunction(counted) and inspect.iscoroutinefunction(checked)
+    assert asyncio.run(counted()) == "pong" and asyncio.run(checked()) == "pong"
+    assert capsys.readouterr().out == ''
+    del func_count['ping']
+
+    session6._nonblocking(print_sink).flush()
+    assert capsys.readouterr().out.splitlines() == [
+        'ping has been called 1 times',
+        'The function ping has a description of more than 50 characters in its docstring.',
+    ]
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        asyncio.run(checker(short)())
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        checker(short, eager=True)
+
+def test_async_reports_share_one_thread():
+    """Reports to many distinct sinks must share one background thread, which must not keep the sinks alive."""
+    async def fetch():
+        return None
+
+    session6._nonblocking(silent_sink)
+    threads = threading.active_count()
+    class Mailbox(list):
+        pass
+
+    mailboxes = [Mailbox() for _ in range(50)]
+    fetchers = [function_counter_multi_dict({}, sink=mailbox.append)(fetch) for mailbox in mailboxes]
+
+    async def main():
+        await asyncio.gather(*(fetcher() for fetcher in fetchers))
+
+    asyncio.run(main())
+    session6._nonblocking(silent_sink).flush()
+    assert all(mailbox == ['fetch has been called 1 times'] for mailbox in mailboxes)
+    assert threading.active_count() == threads
+
+    mailbox = weakref.ref(mailboxes[0])
+    del mailboxes, fetchers
+    gc.collect()
+    assert mailbox() is None
+
+@timing
+def test_async_counter_overhead():
+    """
+    Benchmark: a silenced counter must add at most a couple of microseconds to each awaited call.
+    """
+    async def noop():
+        return None
+
+    counted = function_counter_multi_dict({}, sink=silent_sink)(noop)
+
+    async def drive(fn, calls):
+        start = time.perf_counter()
+        for _ in range(calls):
+            await fn()
+        return (time.perf_counter() - start) / calls
+
+    base = min(asyncio.run(drive(noop, 20000)) for _ in range(3))
+    overhead = min(asyncio.run(drive(counted, 20000)) for _ in range(3)) - base
+    print(f"async counter overhead per call: {overhead * 1e9:.0f}ns")
+    assert overhead < 2e-6
+
+
+######################## Validations for counter snapshots and export ####################
+
+def test_reset_counter_clears_dictionary():
+    """reset_counter must zero the dictionary entry instead of leaving the stale count behind."""
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink)
+    def add(a, b):
+        return a + b
+
+    add(1, 2)
+    add(1, 2)
+    add.reset_counter()
+    assert counts == {'add': 0}
+    add(1, 2)
+    assert counts == {'add': 1}
+
+def test_snapshot_delta_and_reset_all():
+    """
+    Snapshots must be detached copies, scrapes must report calls since the previous scrape (in full
+    after a reset), and reset_all_counters must zero every function at once.
+    """
+    counts = {}
+
+    @function_counter_multi_dict(counts, sink=silent_sink)
+    def add(a, b):
+        return a + b
+
+    @function_counter_multi_dict(counts, sink=silent_sink)
+    def mul(a, b):
+        return a * b
+
+    scraper = CounterScraper(counts)
+    add(1, 2)
+    add(1, 2)
+    mul(2, 3)
+    snapshot = snapshot_counters(counts)
+    assert scraper.scrape() == {'add': 2, 'mul': 1}
+
+    add(1, 2)
+    assert snapshot == {'add': 2, 'mul': 1}
+    assert scraper.scrape() == {'add': 1, 'mul': 0}
+
+    reset_all_counters(counts)
+    assert counts == {'add': 0, 'mul': 0}
+    assert scraper.scrape() == {'add': 0, 'mul': 0}
+    mul(2, 3)
+    assert scraper.scrape() == {'add': 0, 'mul': 1}
+
+    counter = ShardedCounter()
+    counter.increment('add')
+    assert snapshot_counters(counter) == {'add': 1} and CounterScraper(counter).scrape() == {'add': 1}
+    assert snapshot_counters() == func_count and snapshot_counters() is not func_count
+    with pytest.raises(TypeError, match=r"The counter_dict argument must be a dictionary"):
+        reset_all_counters(counter)
+
+def test_counter_export_formats():
+    """The exporters must produce valid Prometheus text and one JSON object per line."""
+    counts = {'add': 2, 'say "hi"': 1}
+    assert export_prometheus(counts) == (
+        '# HELP function_calls_total Number of calls of each decorated function.\n'
+        '# TYPE function_calls_total counter\n'
+        'function_calls_total{function="add"} 2\n'
+        'function_calls_total{function="say \\"hi\\""} 1\n'
+    )
+    lines = export_json_lines(counts, timestamp=12.5).splitlines()
+    assert [json.loads(line) for line in lines] == [
+        {'function': 'add', 'calls': 2, 'timestamp': 12.5},
+        {'function': 'say "hi"', 'calls': 1, 'timestamp': 12.5},
+    ]
+    assert export_json_lines({}) == ''
+
+
+######################## Validations for sampled counting ####################
+
+def test_sampled_counter_stride():
+    """Stride sampling must overshoot the true count by less than the stride, starting at the first call."""
+    counts, messages = {}, []
+
+    @function_counter_multi_dict(counts, sink=messages.append, sample=10)
+    def add(a, b):
+        return a + b
+
+    assert add(1, 2) == 3 and counts == {'add': 10}
+    for calls in range(2, 1001):
+        add(1, 2)
+        assert 0 <= counts['add'] - calls < 10
+    assert len(messages) == 100
+
+    add.reset_counter()
+    assert counts == {'add': 0}
+
+def test_sampled_counter_random_error_bound():
+    """
+    Random sampling must be unbiased: over 200000 calls the extrapolated count must fall within four
+    standard deviations, sqrt(calls * (sample - 1)), of the true count. Other seeds must also be
+    within the bound on average.
+    """
+    calls, sample = 200000, 10
+    bound = 4 * (calls * (sample - 1)) ** 0.5
+    errors = []
+    for seed in range(5):
+        random.seed(seed)
+        counts = {}
+        noop = function_counter_multi_dict(counts, sink=silent_sink, sample=sample, sampling="random")(lambda: None)
+        for _ in range(calls):
+            noop()
+        errors.append(counts['<lambda>'] - calls)
+        assert abs(errors[-1]) <= bound
+    assert abs(sum(errors) / len(errors)) <= bound / len(errors) ** 0.5
+
+def test_sampled_counter_threads():
+    """
+    Under 8 threads, stride sampling must keep its bound and random sampling must stay within four standard
+    deviations, instead of the countdown racing below zero and sampling stopping.
+    """
+    threads, calls, sample = 8, 25000, 2
+    total = threads * calls
+    for sampling in ("stride", "random"):
+        counts = {}
+        noop = function_counter_multi_dict(counts, sink=silent_sink, sample=sample, sampling=sampling)(lambda: None)
+        with ThreadPoolExecutor(threads) as pool:
+            list(pool.map(lambda _: [noop() for _ in range(calls)], range(threads)))
+        if sampling == "stride":
+            assert 0 <= counts['<lambda>'] - total < sample
+        else:
+            assert abs(counts['<lambda>'] - total) <= 4 * (total * (sample - 1)) ** 0.5
+
+def test_sampled_counter_arguments_and_async():
+    """Invalid sampling arguments must be rejected, and coroutine functions must be sampled on completion."""
+    with pytest.raises(ValueError, match=r"The sample argument must be a positive integer"):
+        function_counter_multi_dict({}, sample=0)
+    with pytest.raises(ValueError, match=r"The sampling argument must be 'stride' or 'random'"):
+        function_counter_multi_dict({}, sample=2, sampling="every")
+    with pytest.raises(ValueError, match=r"Sampling cannot be combined with a counter backend"):
+        function_counter_multi_dict({}, sample=2, backend=ShardedCounter())
+
+    counts, messages = {}, []
+
+    @function_counter_multi_dict(counts, sink=messages.append, sample=4)
+    async def ping():
+        return "pong"
+
+    async def main():
+        for _ in range(8):
+            await ping()
+
+    asyncio.run(main())
+    assert counts == {'ping': 8}
+    session6._nonblocking(messages.append).flush()
+    assert messages == ['ping has been called 4 times', 'ping has been called 8 times']
+
+@timing
+def test_sampled_counter_overhead():
+    """Benchmark: a sampled counter must cost less per call than counting every call."""
+    def add(a, b):
+        return a + b
+
+    counted = function_counter_multi_dict({}, sink=silent_sink)(add)
+    sampled = function_counter_multi_dict({}, sink=silent_sink, sample=100)(add)
+    # Interleaved rounds, so that a change in the load of the machine affects both sides alike.
+    rounds = [(per_call_seconds(lambda: counted(1, 2), repeat=3), per_call_seconds(lambda: sampled(1, 2), repeat=3))
+              for _ in range(7)]
+    counted_time = min(counted for counted, _ in rounds)
+    sampled_time = min(sampled for _, sampled in rounds)
+    print(f"per call: counted {counted_time * 1e9:.0f}ns, sampled 1/100 {sampled_time * 1e9:.0f}ns")
+    assert sampled_time < counted_time
+
+
+######################## Validations for compact wrappers ####################
+
+def closure_counter(counter_dict):
+    """The closure-based wrapper `function_counter_multi_dict` returned before `CountedFunction`."""
+    def decorator(fn):
+        name = fn.__name__
+
+        @wraps(fn)
+        def inner(*args, **kwargs):
+            cnt = counter_dict.get(name, 0) + 1
+            counter_dict[name] = cnt
+            return fn(*args, **kwargs)
+
+        def reset_counter():
+            counter_dict[name] = 0
+        inner.reset_counter = reset_counter
+        inner.latency = None
+        return inner
+    return decorator
+
+def bytes_per_wrapper(decorator, count=5000):
+    functions = []
+    for i in range(count):
+        def generated(a, b):
+            return a + b
+        generated.__name__ = f"generated_{i}"
+        functions.append(generated)
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        wrappers = [decorator(fn) for fn in functions]
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    assert len(wrappers) == count
+    return used / count
+
+def test_counted_function_memory():
+    """
+    Memory: a compact decorated function must cost a fraction of the closures, cells and __dict__ it
+    replaces, and the default wrapper, closing over a single slotted object, must cost less than them.
+    """
+    before = bytes_per_wrapper(closure_counter({}))
+    default = bytes_per_wrapper(function_counter_multi_dict({}, sink=silent_sink))
+    after = bytes_per_wrapper(function_counter_multi_dict({}, sink=silent_sink, compact=True))
+    print(f"bytes per decorated function: closures {before:.0f}, default {default:.0f}, CountedFunction {after:.0f}")
+    assert after * 4 < before and default < before
+
+greeter_counts = {}
+
+class Greeter:
+    @function_counter_multi_dict(greeter_counts, sink=silent_sink, compact=True)
+    def greet(self, name):
+        """Greets `name`."""
+        return f"hello {name}"
+
+greet_counted = function_counter_multi_dict(greeter_counts, sink=silent_sink, compact=True)(square)
+
+def test_counted_function_behaves_like_a_function():
+    """The wrapper must bind as a method, pickle by reference and expose the attributes of the function."""
+    assert isinstance(greet_counted, CountedFunction)
+    assert Greeter().greet("you") == "hello you" and greeter_counts['greet'] == 1
+    Greeter.greet.reset_counter()
+    assert greeter_counts['greet'] == 0
+    assert Greeter.greet.__doc__ == "Greets `name`." and Greeter.greet.__module__ == __name__
+    assert CountedFunction.__module__ == 'session6' and 'function_counter_multi_dict' in CountedFunction.__doc__
+
+    global square
+    original, square = square, greet_counted
+    try:
+        assert pickle.loads(pickle.dumps(greet_counted)) is greet_counted
+    finally:
+        square = original
+    with pytest.raises(AttributeError):
+        greet_counted.missing
+
+######################## Validations for qualified-name keys ####################
+
+def make_handler(module):
+    def handler():
+        """Handles nothing."""
+    handler.__module__ = module
+    return handler
+
+def test_qualname_keys_tell_functions_apart():
+    """Functions with the same name in different modules must not share a count with key="qualname"."""
+    counts, latencies = {}, {}
+    users = function_counter_multi_dict(counts, sink=silent_sink, key="qualname", latency_dict=latencies)(
+        make_handler('app.users'))
+    orders = function_counter_multi_dict(counts, sink=silent_sink, key="qualname", latency_dict=latencies)(
+        make_handler('app.orders'))
+    users(), users(), orders()
+    qualname = 'make_handler.<locals>.handler'
+    assert counts == {f'app.users.{qualname}': 2, f'app.orders.{qualname}': 1}
+    assert set(latencies) == set(counts)
+    users.reset_counter()
+    assert counts[f'app.users.{qualname}'] == 0 and users.__name__ == 'handler'
+
+    sharded, backend_counts, sampled_counts = ShardedCounter(), {}, {}
+    wrappers = [function_counter_multi_dict(backend_counts, sink=silent_sink, backend=sharded, key="qualname")(square),
+                function_counter_multi_dict(sampled_counts, sink=silent_sink, sample=2, key="qualname")(square),
+                function_counter_with_one_dict(square, sink=silent_sink, key="qualname")]
+    for wrapper in wrappers:
+        assert wrapper(3) == 9
+    sharded.sync()
+    key = f'{__name__}.square'
+    assert backend_counts == {key: 1} and sampled_counts == {key: 2} and func_count.pop(key) == 1
+
+    same = {}
+    function_counter_multi_dict(same, sink=silent_sink)(make_handler('app.users'))()
+    function_counter_multi_dict(same, sink=silent_sink)(make_handler('app.orders'))()
+    assert same == {'handler': 2}
+    with pytest.raises(ValueError, match=r"The key argument must be 'name' or 'qualname'"):
+        function_counter_multi_dict({}, key="id")
+
+######################## Validations for fused instrumentation ####################
+
+def long_docstring_add(a, b):
+    """
+    This function adds two numbers of any type and returns their sum.
+    """
+    return a + b
+
+def test_instrument_matches_stacked_decorators(capsys):
+    """The fused wrapper must print, count and time like checker stacked on a counter."""
+    stacked_counts, fused_counts, latencies = {}, {}, {}
+    stacked = checker(function_counter_multi_dict(stacked_counts)(long_docstring_add))
+    fused = instrument(counter_dict=fused_counts, latency_dict=latencies)(long_docstring_add)
+
+    assert stacked(1, 2) == 3
+    stacked_out = capsys.readouterr().out
+    assert fused(1, 2) == 3
+    assert capsys.readouterr().out == stacked_out
+    fused(3, 4)
+    assert fused_counts == stacked_counts | {'long_docstring_add': 2}
+    assert capsys.readouterr().out == stacked_out.replace("1 times", "2 times")
+    assert latencies['long_docstring_add'] is fused.latency and fused.latency.count == 2
+    fused.reset_counter()
+    assert fused_counts == {'long_docstring_add': 0}
+    assert fused.__wrapped__ is long_docstring_add and fused.__doc__ == long_docstring_add.__doc__
+
+    messages = []
+    checked_only = instrument(sink=messages.append)(long_docstring_add)
+    checked_only(1, 2)
+    assert messages == ["The function long_docstring_add has a description of more than 50 characters in its docstring."]
+
+    def short():
+        """Short doc"""
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        instrument(sink=silent_sink)(short)()
+    with pytest.raises(ValueError, match=r"requires a docstring longer than 50 characters"):
+        instrument(eager=True, sink=silent_sink)(short)
+    assert instrument(docstring=False, sink=silent_sink)(short)() is None
+
+def test_instrument_coroutine_function():
+    """A fused coroutine wrapper must count and report once, when the coroutine completes."""
+    counts, messages = {}, []
+
+    @instrument(counter_dict=counts, sink=messages.append, eager=True)
+    async def fetch(x):
+        """
+        Pretends to fetch `x` from a remote service and returns it unchanged.
+        """
+        return x
+
+    assert asyncio.run(fetch(5)) == 5 and counts == {'fetch': 1}
+    session6._nonblocking(messages.append).flush()
+    assert messages == ["The function fetch has a description of more than 50 characters in its docstring.",
+                        "fetch has been called 1 times"]
+
+@timing
+def test_instrument_overhead():
+    """Benchmark: the fused wrapper must cost less than checker stacked on a counter with timing."""
+    stacked = checker(function_counter_multi_dict({}, sink=silent_sink, latency_dict={})(long_docstring_add),
+                      sink=silent_sink)
+    fused = instrument(counter_dict={}, latency_dict={}, sink=silent_sink)(long_docstring_add)
+    # Both are timed back to back in each round, so that a change in the load of the machine affects
+    # both sides of a ratio alike, and the median ratio is compared.
+    ratios = sorted(per_call_seconds(lambda: fused(1, 2), repeat=3)
+                    / per_call_seconds(lambda: stacked(1, 2), repeat=3) for _ in range(9))
+    print(f"median time of a fused call relative to a stacked call: {ratios[4]:.2f}")
+    assert ratios[4] < 1
+
+######################## Validations for memoization ####################
+
+def test_memoize_lru_and_counts():
+    """Repeated calls must be served from the cache, the LRU entry evicted first, and hits and misses counted."""
+    counts, calls, messages = {}, [], []
+
+    @memoize(counts, maxsize=2, sink=messages.append)
+    def square(x, offset=0):
+        calls.append(x)
+        return x * x + offset
+
+    assert [square(2), square(2), square(3), square(2), square(4), square(3)] == [4, 4, 9, 4, 16, 9]
+    assert calls == [2, 3, 4, 3]
+    assert counts == {'square.hits': 2, 'square.misses': 4}
+    assert messages[-1] == 'square has been called 6 times, 2 from the cache'
+    assert square(2, offset=1) == 5 and square(2, offset=1) == 5 and square(offset=1, x=2) == 5
+    assert square.cache_info() == {'hits': 3, 'misses': 6, 'size': 2, 'maxsize': 2}
+
+    square.reset_counter()
+    square.cache_clear()
+    assert counts == {'square.hits': 0, 'square.misses': 0} and square.cache_info()['size'] == 0
+    with pytest.raises(TypeError):
+        square([1])
+    with pytest.raises(ValueError, match=r"The maxsize argument must be a positive integer or None"):
+        memoize({}, maxsize=0)
+
+def test_memoize_ttl_and_threads():
+    """Expired results must be recomputed, and concurrent calls must keep the counts consistent."""
+    counts, calls = {}, []
+
+    @memoize(counts, ttl=0.05, sink=silent_sink)
+    def now(x=None):
+        calls.append(x)
+        return len(calls)
+
+    assert now() == now() == 1
+    time.sleep(0.06)
+    assert now() == 2 and counts == {'now.misses': 2, 'now.hits': 1}
+
+    @memoize(counts, maxsize=None, sink=silent_sink)
+    def cube(x):
+        return x ** 3
+
+    with ThreadPoolExecutor(8) as pool:
+        assert list(pool.map(cube, [i % 50 for i in range(20000)])) == [(i % 50) ** 3 for i in range(20000)]
+    assert counts['cube.hits'] + counts['cube.misses'] == 20000 and 50 <= counts['cube.misses'] <= 50 * 8
+
+def test_memoize_coroutine_function():
+    """The awaited result of a coroutine function must be cached, not the coroutine object."""
+    counts = {}
+
+    @memoize(counts, sink=silent_sink)
+    async def fetch(x):
+        """Pretends to fetch `x`."""
+        await asyncio.sleep(0)
+        return [x]
+
+    async def main():
+        return await fetch(1), await fetch(1)
+
+    first, second = asyncio.run(main())
+    assert first == [1] and first is second and counts == {'fetch.misses': 1, 'fetch.hits': 1}
+
+@timing
+def test_memoize_hit_overhead():
+    """Benchmark: a cache hit on a single int argument must cost about as little as a counted call."""
+    def square(x):
+        return x * x
+
+    memoized = memoize({}, sink=silent_sink)(square)
+    memoized(7)
+    hit = per_call_seconds(lambda: memoized(7)) - per_call_seconds(lambda: square(7))
+    print(f"cache hit overhead per call: {hit * 1e9:.0f}ns")
+    assert hit < 2e-6
+
+######################## Validations for rate limiting ####################
+
+def test_rate_limit_token_bucket():
+    """A burst must be admitted at once, the next call rejected, and tokens refilled at the given rate."""
+    counts, messages = {}, []
+
+    @rate_limit(counts, rate=20, burst=3, sink=messages.append)
+    def handler():
+        return "ok"
+
+    assert [handler() for _ in range(3)] == ["ok"] * 3
+    with pytest.raises(RateLimitExceeded, match=r"handler exceeded its limit of 20 calls per second"):
+        handler()
+    assert counts == {'handler.admitted': 3, 'handler.rejected': 1}
+    assert messages[-1] == 'handler exceeded its limit of 20 calls per second and was rejected (1 rejected calls)'
+    time.sleep(0.11)
+    assert handler() == handler() == "ok"
+    handler.reset_counter()
+    assert counts == {'handler.admitted': 0, 'handler.rejected': 0}
+
+    with pytest.raises(ValueError, match=r"The burst argument must be a positive integer, given with a rate"):
+        rate_limit({}, burst=3)
+
+def test_rate_limit_concurrency_cap():
+    """No more than max_concurrent calls may be in progress, in threads or in coroutines."""
+    counts = {}
+    started, release = threading.Barrier(3), threading.Event()
+
+    @rate_limit(counts, max_concurrent=2, sink=silent_sink)
+    def slow():
+        started.wait()
+        release.wait()
+        return "done"
+
+    with ThreadPoolExecutor(2) as pool:
+        futures = [pool.submit(slow) for _ in range(2)]
+        started.wait()
+        with pytest.raises(RateLimitExceeded, match=r"limit of 2 concurrent calls"):
+            slow()
+        release.set()
+        assert [future.result() for future in futures] == ["done", "done"]
+    assert counts == {'slow.admitted': 2, 'slow.rejected': 1}
+
+    @rate_limit(counts, max_concurrent=3, sink=silent_sink)
+    async def fetch(x):
+        """Pretends to fetch `x`."""
+        await asyncio.sleep(0.01)
+        return x
+
+    async def main():
+        return await asyncio.gather(*(fetch(x) for x in range(5)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert results[:3] == [0, 1, 2] and all(isinstance(r, RateLimitExceeded) for r in results[3:])
+    assert asyncio.run(fetch(7)) == 7 and counts['fetch.admitted'] == 4
+
+@timing
+def test_rate_limit_overhead():
+    """Benchmark: under the limits, an admitted call must take no lock and add well under 2 microseconds."""
+    def add(a, b):
+        return a + b
+
+    limited = rate_limit({}, rate=1e9, burst=10 ** 6, max_concurrent=8, sink=silent_sink)(add)
+    overhead = per_call_seconds(lambda: limited(1, 2), calls=20000) - per_call_seconds(lambda: add(1, 2))
+    print(f"rate limit overhead per call: {overhead * 1e9:.0f}ns")
+    assert overhead < 2e-6
+
+######################## Validations for the disable switch ####################
+
+def test_disabled_by_environment_variable():
+    """With SESSION6_DISABLE=1 the decorators must return the identical function object."""
+    code = textwrap.dedent("""
+        import session6
+        def add(a, b):
+            return a + b
+        assert session6.checker(add) is add
+        assert session6.function_counter_with_one_dict(add) is add
+        assert session6.function_counter_multi_dict({})(add) is add
+        assert session6.instrument(counter_dict={})(add) is add
+        assert 'multiprocessing' not in __import__('sys').modules
+    """)
+    env = dict(os.environ, SESSION6_DISABLE="1")
+    subprocess.run([sys.executable, "-c", code], check=True, env=env, cwd=os.path.dirname(session6.__file__))
+
+def test_disabled_instrumentation_keeps_no_function_alive():
+    """Functions decorated while instrumentation is disabled must still be freed once unreferenced."""
+    disable_instrumentation()
+    recorded = len(session6._skipped)
+    try:
+        def generate():
+            def generated():
+                """A generated function, decorated while instrumentation is disabled."""
+            return function_counter_multi_dict({}, sink=silent_sink)(checker(generated))
+
+        refs = [weakref.ref(generate()) for _ in range(100)]
+        gc.collect()
+        assert all(ref() is None for ref in refs)
+        assert len(session6._skipped) == recorded
+    finally:
+        assert enable_instrumentation() == []
+
+def test_enable_instrumentation_by_pattern(tmp_path, monkeypatch):
+    """Functions left undecorated must be decorated again, as stacked, when a pattern re-enables them."""
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "instmod.py").write_text(textwrap.dedent(f'''
+        from session6 import checker, function_counter_multi_dict, silent_sink
+
+        counts = {{}}
+
+        @checker
+        @function_counter_multi_dict(counts, sink=silent_sink)
+        def handler():
+            """{LONG_DOCSTRING}"""
+            return "handled"
+
+        class Users:
+            @function_counter_multi_dict(counts, sink=silent_sink)
+            def get(self):
+                return "user"
+
+        @function_counter_multi_dict(counts, sink=silent_sink)
+        def other():
+            return "other"
+    '''))
+    sys.modules.pop("instmod", None)
+    disable_instrumentation()
+    try:
+        import instmod
+        originals = (instmod.handler, vars(instmod.Users)['get'], instmod.other)
+        assert all(inspect.isfunction(fn) for fn in originals)
+        assert instmod.handler() == "handled" and instmod.counts == {}
+
+        assert enable_instrumentation("instmod.handler", "Users.*") == ['instmod.handler', 'instmod.Users.get']
+        assert instmod.handler is not originals[0] and vars(instmod.Users)["get"].__wrapped__ is originals[1]
+        assert instmod.handler() == "handled" and instmod.Users().get() == "user"
+        assert instmod.counts == {'handler': 1, 'get': 1} and instmod.other is originals[2]
+    finally:
+        assert enable_instrumentation() == ['instmod.other']
+    assert instmod.other() == "other" and instmod.counts['other'] == 1
+    assert checker(square) is not square
+
+def test_enable_instrumentation_keeps_failures(tmp_path, monkeypatch, caplog):
+    """Functions that cannot be decorated again or replaced must be logged and kept for the next call."""
+    monkeypatch.syspath_prepend(str(tmp_path))
+    (tmp_path / "failmod.py").write_text(textwrap.dedent(f'''
+        from session6 import checker, function_counter_multi_dict, silent_sink
+
+        def make_nested():
+            @function_counter_multi_dict({{}}, sink=silent_sink)
+            def nested():
+                return "nested"
+            return nested
+
+        nested = make_nested()
+
+        def short():
+            """Short doc"""
+        short = checker(short, eager=True)
+
+        @function_counter_multi_dict({{}}, sink=silent_sink)
+        def fine():
+            return "fine"
+    '''))
+    sys.modules.pop("failmod", None)
+    disable_instrumentation()
+    try:
+        import failmod
+        short = failmod.short
+        with caplog.at_level(logging.WARNING, logger="session6"):
+            assert enable_instrumentation("failmod.*") == ['failmod.fine']
+        assert "Could not replace failmod.make_nested.<locals>.nested" in caplog.text
+        assert "Could not decorate failmod.short again" in caplog.text
+        assert failmod.short is short and hasattr(failmod.fine, "__wrapped__")
+
+        failmod.short.__doc__ = LONG_DOCSTRING
+        caplog.clear()
+        with caplog.at_level(logging.WARNING, logger="session6"):
+            assert enable_instrumentation("failmod.*") == ['failmod.short']
+        assert failmod.short is not short and failmod.short.__wrapped__ is short
+        assert "failmod.short" not in caplog.text and "failmod.make_nested.<locals>.nested" in caplog.text
+    finally:
+        enable_instrumentation()
+
+######################## Validations for argument shapes ####################
+
+def test_shape_table_counts_and_bound():
+    """Calls must be bucketed by argument types and keyword names, and new shapes overflow past maxsize."""
+    shapes = {}
+
+    @function_counter_multi_dict({}, sink=silent_sink, shape_dict=shapes)
+    def scale(x, y=1, *, factor=1):
+        return x * y * factor
+
+    for _ in range(3):
+        scale(1, 2)
+    scale(1.5, 2)
+    scale("a", factor=2)
+    scale(1, y=2, factor=3)
+    assert shapes['scale'] is scale.shapes and len(scale.shapes) == 4
+    assert scale.shapes.most_common() == [
+        ('(int, int)', 3), ('(float, int)', 1), ('(str, factor=int)', 1), ('(int, y=int, factor=int)', 1),
+    ]
+    assert scale.shapes.most_common(1) == [('(int, int)', 3)]
+
+    table = ShapeTable(maxsize=2)
+    for value in (1, "a", 1.5, b"b", 2):
+        table.record((value,), {})
+    assert table.most_common() == [('(int)', 2), ('(str)', 1)] and table.overflow == 2
+    table.reset()
+    assert len(table) == 0 and table.overflow == 0
+
+    timed = function_counter_with_one_dict(square, sink=silent_sink, shapes=True)
+    timed(3)
+    assert func_shapes['square'].most_common() == [('(int)', 1)]
+    del func_shapes['square'], func_count['square']
+
+    sampled = function_counter_multi_dict({}, sink=silent_sink, sample=2, shape_dict={})(square)
+    for x in range(4):
+        sampled(x)
+    assert sampled.shapes.most_common() == [('(int)', 2)]
+
+@timing
+def test_shape_profiling_overhead():
+    """Benchmark: bucketing calls by argument shape must add less than a microsecond per call."""
+    def add(a, b):
+        return a + b
+
+    counted = function_counter_multi_dict({}, sink=silent_sink)(add)
+    profiled = function_counter_multi_dict({}, sink=silent_sink, shape_dict={})(add)
+    added = per_call_seconds(lambda: profiled(1, 2)) - per_call_seconds(lambda: counted(1, 2))
+    print(f"shape profiling cost per call: {added * 1e9:.0f}ns")
+    assert added < 1e-6
+
+######################## Validations for parallel Fibonacci ranges ####################
+
+def test_fibonacci_range_in_order():
+    """Chunks generated in parallel must stream back in order and match the sequential terms."""
+    expected = [fibonacci(n) for n in range(95, 300)]
+    assert list(fibonacci_range(95, 300, processes=2, chunk_size=7)) == expected
+    assert list(fibonacci_range(95, 300, processes=1, chunk_size=7)) == expected
+
+    modulus = 10 ** 9 + 7
+    terms = list(fibonacci_range(10 ** 6, 10 ** 6 + 5000, modulus=modulus, processes=2, chunk_size=1000))
+    assert terms[0] == fibonacci(10 ** 6, modulus) and terms[-1] == fibonacci(10 ** 6 + 4999, modulus)
+    assert list(fibonacci_range(5, 5)) == []
+
+    stream = fibonacci_range(0, 10 ** 9, modulus=modulus, processes=2, chunk_size=1000)
+    assert list(islice(stream, 3)) == [0, 1, 1]
+    stream.close()
+
+    with pytest.raises(ValueError, match=r"The stop argument must not be below the start argument"):
+        fibonacci_range(10, 5)
+    with pytest.raises(TypeError, match=r"The start argument must be an integer"):
+        fibonacci_range(1.5, 5)
+
+######################## Validations for the benchmark suite ####################
+
+def test_benchmark_regression_threshold():
+    """A benchmark must only fail when it is worse than its baseline by more than the threshold."""
+    from benchmark_session6 import compare
+
+    baseline = {'overhead': {'value': 2.0, 'lower': True}, 'terms': {'value': 100.0, 'lower': False}}
+    results = {'overhead': {'value': 2.4, 'lower': True}, 'terms': {'value': 85.0, 'lower': False},
+               'new': {'value': 1.0, 'lower': True}}
+    assert compare(results, baseline, threshold=0.25) == []
+
+    results = {'overhead': {'value': 2.6, 'lower': True}, 'terms': {'value': 75.0, 'lower': False}}
+    assert compare(results, baseline, threshold=0.25) == [
+        'overhead: 2.6 against a baseline of 2',
+        'terms: 75 against a baseline of 100',
+    ]